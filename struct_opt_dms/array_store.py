@@ -0,0 +1,197 @@
+'''
+Chunked, optionally compressed, on-disk Numpy arrays.
+
+An array is stored as a folder holding a small JSON manifest (shape, type,
+chunk shape, compression) and one binary file per chunk. Reading a slice
+(e.g. one DM trial of `power_vs_dm`, or a channel range of a waterfall)
+only reads and decompresses the chunks it overlaps.
+'''
+import json
+import os
+import shutil
+import tempfile
+import zlib
+from itertools import product
+
+import numpy as np
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+
+def get_chunk_shape(shape, itemsize, chunk_bytes=2**20):
+    """Chunk shape of at most `chunk_bytes`, halving the largest dimension until it fits."""
+    chunks = list(shape)
+    while int(np.prod(chunks)) * itemsize > chunk_bytes and max(chunks) > 1:
+        largest = int(np.argmax(chunks))
+        chunks[largest] = (chunks[largest] + 1) // 2
+    return tuple(max(1, c) for c in chunks)
+
+def _chunk_name(index):
+    return '.'.join(str(i) for i in index) or '0'
+
+def save_array(path, array, chunks=None, compression='zlib', level=1, chunk_bytes=2**20):
+    """Store an array as a folder of chunks.
+
+    Parameters
+    ----------
+    path : str
+        Folder of the stored array (replaced if it exists)
+    array : Numpy.Array
+        Array to store
+    chunks : tuple
+        Chunk shape (default: from `get_chunk_shape`)
+    compression : str
+        'zlib' or None
+    level : int
+        zlib compression level (1: fastest, 9: smallest)
+    chunk_bytes : int
+        Size of the chunks when `chunks` is not given (default: 1 MiB)
+
+    """
+    array = np.asarray(array)
+    if array.dtype.hasobject:
+        raise TypeError('Arrays of Python objects cannot be stored, use pickle')
+    if compression not in ('zlib', None):
+        raise ValueError("`compression` must be 'zlib' or None, got %s" % compression)
+    if chunks is None:
+        chunks = get_chunk_shape(array.shape, array.dtype.itemsize, chunk_bytes)
+    chunks = tuple(int(c) for c in chunks)
+
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    # write to a temporary folder and rename it, so readers never see partial arrays
+    tmp = tempfile.mkdtemp(dir=folder, prefix='.tmp_')
+    try:
+        grid = [range(0, n, c) for n, c in zip(array.shape, chunks)]
+        for start in product(*grid):
+            block = array[tuple(slice(s, s + c) for s, c in zip(start, chunks))]
+            data = np.ascontiguousarray(block).tobytes()
+            if compression == 'zlib':
+                data = zlib.compress(data, level)
+            index = tuple(s // c for s, c in zip(start, chunks))
+            with open(os.path.join(tmp, _chunk_name(index)), 'wb') as f:
+                f.write(data)
+
+        with open(os.path.join(tmp, MANIFEST), 'w') as f:
+            json.dump({'version': VERSION,
+                       'shape': list(array.shape),
+                       'dtype': array.dtype.str,
+                       'chunks': list(chunks),
+                       'compression': compression}, f)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+def is_array(path):
+    """Whether `path` is an array stored by `save_array`."""
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+class StoredArray():
+    """Array stored by `save_array`, read lazily by slices."""
+
+    def __init__(self, path):
+        """Initialise StoredArray class.
+
+        Parameters
+        ----------
+        path : str
+            Folder of the stored array
+
+        """
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest['version'] > VERSION:
+            raise ValueError('Unsupported array store version %d' % manifest['version'])
+        self.path = path
+        self.shape = tuple(manifest['shape'])
+        self.dtype = np.dtype(manifest['dtype'])
+        self.chunks = tuple(manifest['chunks'])
+        self.compression = manifest['compression']
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[...]
+        return array if dtype is None else array.astype(dtype)
+
+    def read_chunk(self, index):
+        """Read the chunk at position `index` of the chunk grid."""
+        start = [i * c for i, c in zip(index, self.chunks)]
+        shape = [min(c, n - s) for s, c, n in zip(start, self.chunks, self.shape)]
+        with open(os.path.join(self.path, _chunk_name(index)), 'rb') as f:
+            data = f.read()
+        if self.compression == 'zlib':
+            data = zlib.decompress(data)
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+    def _normalise_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) != self.ndim:
+            raise IndexError('Too many indices for an array of %d dimensions' % self.ndim)
+        for k in key:
+            if not isinstance(k, (slice, int, np.integer)):
+                raise TypeError('Stored arrays only support integer and slice indices')
+        return key
+
+    def __getitem__(self, key):
+        """Read a slice of the array, touching only the chunks it overlaps."""
+        key = self._normalise_key(key)
+
+        # bounding box of the selection in every dimension
+        selections, lows, highs = [], [], []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, slice):
+                indices = np.arange(n)[k]
+            else:
+                if not -n <= k < n:
+                    raise IndexError('Index %d is out of bounds for size %d' % (k, n))
+                indices = k % n
+            selections.append(indices)
+            lows.append(int(np.min(indices)) if np.size(indices) else 0)
+            highs.append(int(np.max(indices)) + 1 if np.size(indices) else 0)
+
+        box = np.empty([h - l for l, h in zip(lows, highs)], dtype=self.dtype)
+        if box.size:
+            grid = [range(l // c, (h - 1) // c + 1) for l, h, c in zip(lows, highs, self.chunks)]
+            for index in product(*grid):
+                chunk = self.read_chunk(index)
+                start = [i * c for i, c in zip(index, self.chunks)]
+                # overlap of the chunk and the box
+                src, dst = [], []
+                for s, size, l, h in zip(start, chunk.shape, lows, highs):
+                    a, b = max(s, l), min(s + size, h)
+                    src.append(slice(a - s, b - s))
+                    dst.append(slice(a - l, b - l))
+                box[tuple(dst)] = chunk[tuple(src)]
+
+        # selection within the box (last dimensions first, as integer
+        # indices remove their dimension)
+        for axis in reversed(range(self.ndim)):
+            indices, low = selections[axis], lows[axis]
+            if np.ndim(indices) == 0:
+                box = np.take(box, indices - low, axis=axis)
+            elif indices.size and (indices.size != box.shape[axis] or indices[0] != low):
+                box = np.take(box, indices - low, axis=axis)
+        return box
+
+def open_array(path):
+    """Open an array stored by `save_array` for lazy, sliced reading."""
+    return StoredArray(path)
+
+def load_array(path):
+    """Read a whole array stored by `save_array`."""
+    return StoredArray(path)[...]
@@ -0,0 +1,290 @@
+'''
+Headless batch processing of many bursts.
+
+Runs the notebook pipeline (`initialize` -> `prep_power` -> DM curve fit)
+over a list of filterbanks, without widgets, figures or `builtins` globals,
+and writes the structure-optimised DM, its uncertainty and the S/N of each
+burst to a CSV file.
+
+Usage:
+    python -m struct_opt_dms.batch bursts.csv results.csv --n-processes 8
+
+where bursts.csv has the columns `filename`, `dm` and, optionally,
+`burst_id`. A folder of filterbanks can be given instead of a CSV file,
+with a common estimated DM (`--dm`).
+'''
+import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .interactive_analysis import initialize, initialize_observation, prep_adaptive_power, prep_power
+from .catalogue import ResultsCatalogue
+from .dm_search import fit_dm_curve
+from .matched_filter import get_profiles, matched_filter
+from .power_cache import PowerCache
+from .processing import fit_coherent_power, psnr
+
+RESULT_FIELDS = ['burst_id', 'filename', 'estimated_dm', 'dm', 'dm_err', 'snr',
+                 'boxcar_snr', 'boxcar_width', 'fluct_id_low', 'fluct_id_high',
+                 'freq_id_low', 'freq_id_high', 'fitting_method', 'status', 'time']
+
+def read_bursts(path, dm=None, ext='.fil'):
+    """List the bursts to process.
+
+    Parameters
+    ----------
+    path : str
+        CSV file with columns `filename`, `dm` and optionally `burst_id`
+        (relative file names are relative to the CSV file), or a folder of
+        filterbank files
+    dm : float
+        Estimated DM of every file of a folder
+    ext : str
+        Extension of the filterbank files of a folder
+
+    Returns
+    -------
+    bursts : list
+        List of dict with keys `burst_id`, `filename` and `dm`
+
+    """
+    if os.path.isdir(path):
+        if dm is None:
+            raise ValueError('An estimated DM (--dm) is needed to process a folder')
+        filenames = sorted(entry.path for entry in os.scandir(path)
+                           if entry.is_file() and entry.name.lower().endswith(ext))
+        return [{'burst_id': os.path.splitext(os.path.basename(filename))[0],
+                 'filename': filename,
+                 'dm': float(dm)} for filename in filenames]
+
+    bursts = []
+    folder = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            filename = os.path.join(folder, row['filename'].strip())
+            burst_dm = row.get('dm') or dm
+            if burst_dm in (None, ''):
+                raise ValueError('No estimated DM for %s' % filename)
+            bursts.append({'burst_id': (row.get('burst_id') or '').strip() or
+                                       os.path.splitext(os.path.basename(filename))[0],
+                           'filename': filename,
+                           'dm': float(burst_dm)})
+    return bursts
+
+def get_fit_status(dm_trials, dm_curve, dm, dm_std):
+    """Status of a DM curve fit: 'ok', or why it did not find a maximum.
+
+    `poly_max` returns dm=0, dm_std=0 when the polynomial has no maximum, and
+    a DM curve peaking on the first or last trial has no maximum within the
+    grid (the DM is beyond `dm_range`).
+    """
+    peak = np.argmax(dm_curve)
+    if peak == 0 or peak == len(dm_curve) - 1:
+        return 'failed: peak on the edge of the DM trials'
+    if not np.isfinite(dm_std) or dm_std <= 0 or not np.min(dm_trials) <= dm <= np.max(dm_trials):
+        return 'failed: no maximum'
+    return 'ok'
+
+def process_burst(filename,
+                  estimated_dm,
+                  burst_id=None,
+                  downsampling=1,
+                  dm_step=0.1,
+                  dm_range=10,
+                  t_zoom=0.1,
+                  fluct_id_low=0,
+                  fluct_id_high=30,
+                  freq_id_low=0,
+                  freq_id_high=None,
+                  fitting_method='dm_phase',
+                  cache_folder=None,
+                  adaptive=False,
+                  verbose=False):
+    """Measure the structure-optimised DM of one burst.
+
+    With `adaptive`, the DM trials are a coarse grid of half-width
+    `dm_range` (step sized from the smearing, `dm_step` is not used) refined
+    around the peak of the DM curve, see `prep_adaptive_power`. The power
+    maps are then not cached.
+
+    Returns
+    -------
+    result : dict
+        Values of RESULT_FIELDS. DMs are absolute (pc/cm^3), `time` is when
+        the measurement was made (seconds since the epoch). `status` is not
+        'ok' when the fit found no maximum (see `get_fit_status`).
+
+    """
+    spectra, dm_trials, _ = initialize(filename,
+                                       estimated_dm,
+                                       downsampling,
+                                       dm_step=dm_step,
+                                       dm_range=dm_range,
+                                       t_zoom=t_zoom,
+                                       verbose=verbose)
+
+    if adaptive:
+        dm_trials, power_vs_dm, d_power_vs_dm = prep_adaptive_power(spectra,
+                                                                    dm_range=dm_range,
+                                                                    freq_id_low=freq_id_low,
+                                                                    freq_id_high=freq_id_high,
+                                                                    fluct_id_low=fluct_id_low,
+                                                                    fluct_id_high=fluct_id_high,
+                                                                    verbose=verbose)
+    else:
+        power_vs_dm, d_power_vs_dm = prep_power(spectra,
+                                                dm_trials,
+                                                freq_id_low=freq_id_low,
+                                                freq_id_high=freq_id_high,
+                                                cache=None if cache_folder is None else PowerCache(cache_folder),
+                                                verbose=verbose)
+
+    waterfall, f_channels, freq_id_high, _ = initialize_observation(spectra,
+                                                                    freq_id_low=freq_id_low,
+                                                                    freq_id_high=freq_id_high)
+    dm_curve = d_power_vs_dm[fluct_id_low:fluct_id_high].sum(axis=0)
+    if fitting_method == 'dm_phase':
+        dm, dm_std, snr = fit_dm_curve(dm_trials, d_power_vs_dm, f_channels, fluct_id_low, fluct_id_high)
+    else:
+        dm, dm_std, _, _ = fit_coherent_power(dm_trials, dm_curve)
+        snr = psnr(dm_curve)
+
+    # S/N of the profile dedispersed to the structure-optimised DM
+    width, boxcar_snr, _ = matched_filter(get_profiles(waterfall, [dm], f_channels, spectra.dt)[0])
+
+    return {'burst_id': burst_id,
+            'filename': filename,
+            'estimated_dm': estimated_dm,
+            'dm': spectra.dm + dm,
+            'dm_err': dm_std,
+            'snr': snr,
+            'boxcar_snr': boxcar_snr,
+            'boxcar_width': width,
+            'fluct_id_low': fluct_id_low,
+            'fluct_id_high': fluct_id_high,
+            'freq_id_low': freq_id_low,
+            'freq_id_high': freq_id_high,
+            'fitting_method': fitting_method,
+            'status': get_fit_status(dm_trials, dm_curve, dm, dm_std),
+            'time': time.time()}
+
+def _process_burst(burst, kwargs):
+    """`process_burst` returning a failed result instead of raising."""
+    try:
+        return process_burst(burst['filename'], burst['dm'], burst_id=burst['burst_id'], **kwargs)
+    except Exception as e:
+        return {'burst_id': burst['burst_id'],
+                'filename': burst['filename'],
+                'estimated_dm': burst['dm'],
+                'status': 'error: %s: %s' % (type(e).__name__, e),
+                'time': time.time()}
+
+def run(bursts, n_processes=None, **kwargs):
+    """Process bursts, in a pool of `n_processes` processes if given.
+
+    Parameters
+    ----------
+    bursts : list
+        Bursts, see `read_bursts`
+    n_processes : int
+        Number of processes (default: None, serially in this process)
+    kwargs :
+        Passed to `process_burst`
+
+    Yields
+    ------
+    result : dict
+        Result of each burst, in the order of `bursts`
+
+    """
+    if n_processes is None or n_processes < 2:
+        for burst in bursts:
+            yield _process_burst(burst, kwargs)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        futures = [executor.submit(_process_burst, burst, kwargs) for burst in bursts]
+        for future in futures:
+            yield future.result()
+
+def write_results(results, filename, catalogue=None):
+    """Write results to a CSV file (with RESULT_FIELDS columns) as they come.
+
+    Successful results are also added to `catalogue` (a
+    catalogue.ResultsCatalogue) if given, in a single transaction at the end.
+
+    Returns
+    -------
+    n_ok, n_failed : int, int
+
+    """
+    n_ok, n_failed = 0, 0
+    measurements = []
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, restval='')
+        writer.writeheader()
+        for result in results:
+            writer.writerow({key: value.item() if isinstance(value, np.generic) else value
+                             for key, value in result.items()})
+            f.flush()
+            if result['status'] == 'ok':
+                n_ok += 1
+                measurements.append(result)
+            else:
+                n_failed += 1
+                print ('%s: %s' % (result['filename'], result['status']), file=sys.stderr)
+
+    if catalogue is not None:
+        catalogue.add_many(measurements)
+    return n_ok, n_failed
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m struct_opt_dms.batch',
+        description='Measure structure-optimised DMs of many bursts.')
+    parser.add_argument('bursts',
+                        help='CSV file (filename, dm[, burst_id]) or folder of filterbanks')
+    parser.add_argument('output', help='Results CSV file')
+    parser.add_argument('--dm', type=float, default=None,
+                        help='Estimated DM of the files of a folder (or missing from the CSV)')
+    parser.add_argument('--n-processes', type=int, default=None,
+                        help='Number of processes (default: serial)')
+    parser.add_argument('--downsampling', type=int, default=1)
+    parser.add_argument('--dm-step', type=float, default=0.1)
+    parser.add_argument('--dm-range', type=float, default=10)
+    parser.add_argument('--t-zoom', type=float, default=0.1,
+                        help='Length of the cropped waterfall (second)')
+    parser.add_argument('--fluct-id-low', type=int, default=0)
+    parser.add_argument('--fluct-id-high', type=int, default=30)
+    parser.add_argument('--freq-id-low', type=int, default=0)
+    parser.add_argument('--freq-id-high', type=int, default=None)
+    parser.add_argument('--fitting-method', default='dm_phase',
+                        help="'dm_phase' (polynomial fit) or 'gaussian'")
+    parser.add_argument('--cache', default=None, dest='cache_folder',
+                        help='Folder of the power_vs_dm cache (default: no cache)')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Coarse-to-fine DM trials around the peak (--dm-step is not used)')
+    parser.add_argument('--catalogue', default=None,
+                        help='SQLite results catalogue to add the measurements to')
+    parser.add_argument('--verbose', action='store_true')
+    return parser
+
+def main(argv=None):
+    args = vars(get_parser().parse_args(argv))
+    bursts = read_bursts(args.pop('bursts'), dm=args.pop('dm'))
+    output = args.pop('output')
+    n_processes = args.pop('n_processes')
+    catalogue = args.pop('catalogue')
+    catalogue = None if catalogue is None else ResultsCatalogue(catalogue)
+
+    n_ok, n_failed = write_results(run(bursts, n_processes=n_processes, **args), output, catalogue)
+    print ('%d bursts processed, %d failed. Results in %s' % (n_ok, n_failed, output))
+    return 1 if n_failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
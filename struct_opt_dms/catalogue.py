@@ -0,0 +1,184 @@
+'''
+SQLite catalogue of structure-optimised DM measurements.
+
+Each row holds one measurement: the burst, its source filterbank, the DM and
+its uncertainty, the S/N, the fluctuation frequency and channel ranges and
+the fitting method, with the time it was recorded. Rows are indexed by
+source and by time, so past measurements can be queried without opening
+one state file per variable.
+'''
+import os
+import sqlite3
+import time
+
+COLUMNS = [
+    ('burst_id', 'TEXT'),
+    ('source', 'TEXT'),
+    ('estimated_dm', 'REAL'),
+    ('dm', 'REAL'),
+    ('dm_err', 'REAL'),
+    ('snr', 'REAL'),
+    ('boxcar_snr', 'REAL'),
+    ('boxcar_width', 'INTEGER'),
+    ('fluct_id_low', 'INTEGER'),
+    ('fluct_id_high', 'INTEGER'),
+    ('freq_id_low', 'INTEGER'),
+    ('freq_id_high', 'INTEGER'),
+    ('fitting_method', 'TEXT'),
+    ('time', 'REAL'),
+]
+FIELDS = [name for name, _ in COLUMNS]
+# a measurement is identified by these fields: adding it again (e.g. when a
+# farm run resumes, or a batch is run again) updates it instead of adding a row
+KEY = ['burst_id', 'source', 'fitting_method', 'freq_id_low', 'freq_id_high']
+# missing KEY fields are stored as these values rather than NULL, which never
+# conflicts in a unique index (so measurements without e.g. a source would be
+# added again instead of updated); queries return them as None
+KEY_MISSING = {name: {'TEXT': '', 'INTEGER': -1}[type_] for name, type_ in COLUMNS if name in KEY}
+
+def _to_sql(value):
+    # Numpy scalars -> Python scalars
+    return value.item() if hasattr(value, 'item') else value
+
+class ResultsCatalogue():
+    """Catalogue of DM measurements in a local SQLite database."""
+
+    def __init__(self, filename='results.sqlite'):
+        """Initialise ResultsCatalogue class.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the database (created if needed)
+
+        """
+        self.filename = filename
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(filename)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS measurements '
+                '(id INTEGER PRIMARY KEY, %s)' % ', '.join('%s %s' % column for column in COLUMNS))
+            self.connection.execute('CREATE INDEX IF NOT EXISTS measurements_source ON measurements (source)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS measurements_time ON measurements (time)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS measurements_burst_id ON measurements (burst_id)')
+            if self.connection.execute('SELECT 1 FROM measurements WHERE %s LIMIT 1' % ' OR '.join(
+                    '%s IS NULL' % field for field in KEY)).fetchone() is not None:
+                # rows added with NULL KEY fields: normalise them, then
+                # rebuild the key below to remove the duplicates
+                self.connection.execute('DROP INDEX IF EXISTS measurements_key')
+                for field, missing in KEY_MISSING.items():
+                    self.connection.execute(
+                        'UPDATE measurements SET %s = ? WHERE %s IS NULL' % (field, field), (missing,))
+            if self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND "
+                                       "name = 'measurements_key'").fetchone() is None:
+                # catalogues written before measurements had a key may hold
+                # duplicates: keep the last added of each
+                self.connection.execute(
+                    'DELETE FROM measurements WHERE id NOT IN '
+                    '(SELECT MAX(id) FROM measurements GROUP BY %s)' % ', '.join(KEY))
+                self.connection.execute(
+                    'CREATE UNIQUE INDEX measurements_key ON measurements (%s)' % ', '.join(KEY))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM measurements').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def _row(self, measurement):
+        """Values of FIELDS from a measurement dict (e.g. a `batch` result,
+        where the source filterbank is under 'filename'). `time` defaults to
+        now when the measurement has none."""
+        measurement = dict(measurement)
+        if 'source' not in measurement:
+            measurement['source'] = measurement.get('filename')
+        if measurement.get('time') is None:
+            measurement['time'] = time.time()
+        for field, missing in KEY_MISSING.items():
+            if measurement.get(field) is None:
+                measurement[field] = missing
+        return tuple(_to_sql(measurement.get(field)) for field in FIELDS)
+
+    def add(self, **measurement):
+        """Add one measurement (keyword arguments named after FIELDS)."""
+        self.add_many([measurement])
+
+    def add_many(self, measurements):
+        """Add measurements (dicts with FIELDS keys) in a single transaction.
+
+        A measurement with the same KEY fields as one already in the
+        catalogue replaces its values.
+
+        Returns
+        -------
+        n : int
+            Number of measurements added or updated
+
+        """
+        rows = [self._row(measurement) for measurement in measurements]
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO measurements (%s) VALUES (%s) ON CONFLICT (%s) DO UPDATE SET %s' % (
+                    ', '.join(FIELDS),
+                    ', '.join('?' * len(FIELDS)),
+                    ', '.join(KEY),
+                    ', '.join('%s = excluded.%s' % (field, field) for field in FIELDS if field not in KEY)),
+                rows)
+        return len(rows)
+
+    def query(self, source=None, burst_id=None, since=None, until=None, limit=None):
+        """Measurements matching every given criterion, most recent first.
+
+        Parameters
+        ----------
+        source : str
+            Source filterbank
+        burst_id : str
+            Burst identifier
+        since, until : float
+            Time range (seconds since the epoch) of the measurements
+        limit : int
+            Maximum number of measurements
+
+        Returns
+        -------
+        measurements : list
+            List of dict with keys 'id' and FIELDS
+
+        """
+        conditions, values = [], []
+        for condition, value in [('source = ?', source),
+                                 ('burst_id = ?', burst_id),
+                                 ('time >= ?', since),
+                                 ('time <= ?', until)]:
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+
+        sql = 'SELECT * FROM measurements'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY time DESC, id DESC'
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        measurements = [dict(row) for row in self.connection.execute(sql, values)]
+        for measurement in measurements:
+            for field, missing in KEY_MISSING.items():
+                if measurement[field] == missing:
+                    measurement[field] = None
+        return measurements
+
+    def latest(self, source=None, burst_id=None):
+        """Most recent measurement of a source or burst (None if there is none)."""
+        measurements = self.query(source=source, burst_id=burst_id, limit=1)
+        return measurements[0] if measurements else None
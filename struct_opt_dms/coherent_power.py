@@ -0,0 +1,522 @@
+'''
+Coherent power vs DM computed in the Fourier domain.
+
+Rolling a channel by `s` samples multiplies its Fourier transform by the
+phase ramp exp(-2πi k s / N), and the coherent spectrum only depends on the
+phases of the Fourier transform. The waterfall is therefore transformed and
+normalised once, and every DM trial is obtained by applying per-channel phase
+ramps to the normalised spectra instead of re-dedispersing the waterfall and
+running a full 2D FFT per trial.
+'''
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy.fft import rfft
+
+from .dm_phase import compute_dedispersion_delay, get_dedispersion_shift
+from .extern.time_domain_astronomy_sandbox.rfim import unpack_mask
+
+def get_nbin(nsamp):
+    """Number of fluctuation frequency bins kept for a waterfall of `nsamp` samples."""
+    return int(np.round(nsamp / 2))
+
+def get_channel_weights(mask, nsamp=None, max_flagged=0.5):
+    """Get per-channel weights from an RFI mask.
+
+    Parameters
+    ----------
+    mask : Numpy.Array
+        2D boolean Array (channel, time) of flagged samples, or the same mask
+        bit-packed by `rfim.pack_mask` (then `nsamp` is required)
+    nsamp : int
+        Number of time samples of a packed mask
+    max_flagged : float
+        Channels with a larger fraction of flagged samples get a zero weight
+
+    Returns
+    -------
+    weights : Numpy.Array
+        Weight of each channel (0 or 1)
+
+    """
+    if mask.dtype == np.uint8:
+        if nsamp is None:
+            raise ValueError('`nsamp` is needed to unpack a packed mask')
+        mask = unpack_mask(mask, nsamp)
+    flagged = np.mean(mask, axis=1)
+    return (flagged <= max_flagged).astype(float)
+
+def get_phasors(waterfall, nbin=None, workers=None, dtype=np.complex128, weights=None):
+    """Get the unit phasors of the waterfall's (real input) Fourier transform.
+
+    Parameters
+    ----------
+    waterfall : Numpy.Array
+        2D Array (channel, time)
+    nbin : int
+        Number of fluctuation frequency bins to keep (default: all,
+        i.e. nsamp // 2 + 1)
+    workers : int
+        Number of workers of `scipy.fft.rfft` (default: None, i.e. one)
+    dtype : Numpy.dtype
+        Complex type of the phasors: complex128 or complex64 (in which case
+        the FFT runs in single precision)
+    weights : Numpy.Array
+        Weight of each channel's phasors (optional)
+
+    Returns
+    -------
+    phasors : Numpy.Array
+        2D complex Array (channel, fluctuation frequency)
+
+    """
+    real_type = np.finfo(dtype).dtype
+    ft_waterfall = rfft(np.asarray(waterfall, dtype=real_type), workers=workers)
+    if nbin is not None:
+        ft_waterfall = ft_waterfall[:, :nbin]
+    amp = np.abs(ft_waterfall)
+    amp[amp == 0] = 1
+    if weights is not None:
+        amp /= np.asarray(weights, dtype=real_type)[:, np.newaxis]
+    ft_waterfall /= amp
+    return ft_waterfall
+
+def get_twiddle(nsamp, dtype=np.complex128):
+    """Get the table of the `nsamp` roots of unity exp(-2πi m / nsamp)."""
+    return np.exp(-2j * np.pi * np.arange(nsamp) / nsamp).astype(dtype)
+
+def get_phase_ramps(shift, nbin, nsamp, twiddle=None):
+    """Get the phase ramps equivalent to rolling each channel by `shift` samples.
+
+    Shifts are integers, so the ramps are exact lookups in the table of roots
+    of unity and match `np.roll` in the time domain.
+
+    Parameters
+    ----------
+    shift : Numpy.Array
+        Shift (in samples) of each channel
+    nbin : int
+        Number of fluctuation frequency bins
+    nsamp : int
+        Number of time samples of the waterfall
+    twiddle : Numpy.Array
+        Precomputed output of `get_twiddle(nsamp)` (optional)
+
+    Returns
+    -------
+    ramps : Numpy.Array
+        2D complex Array (channel, fluctuation frequency)
+
+    """
+    if twiddle is None:
+        twiddle = get_twiddle(nsamp)
+    return twiddle[np.outer(np.asarray(shift) % nsamp, np.arange(nbin)) % nsamp]
+
+def get_shift_table(dm_trials, freq, dt, ref_freq="top", fractional=False):
+    """Get the shift (in samples) of every channel for every DM trial.
+
+    Shifts are rounded to whole samples (as `dedisperse_waterfall`), unless
+    `fractional` is True.
+
+    Returns
+    -------
+    shifts : Numpy.Array
+        2D Array (channel, DM trial), of integers or (if `fractional`) floats
+
+    """
+    if fractional:
+        return np.stack([compute_dedispersion_delay(dm, freq, dt, ref_freq=ref_freq)
+                         for dm in dm_trials], axis=1)
+    return np.stack([get_dedispersion_shift(dm, freq, dt, ref_freq=ref_freq)
+                     for dm in dm_trials], axis=1)
+
+def get_chunk_sizes(nbin, nchan, ndm, max_chunk_bytes, dtype=np.complex128):
+    """Split a (nbin, nchan, ndm) block of phase ramps into chunks
+    of at most `max_chunk_bytes`.
+
+    Returns
+    -------
+    bin_chunk, dm_chunk : int, int
+        Number of fluctuation frequency bins and DM trials per chunk
+
+    """
+    itemsize = np.dtype(dtype).itemsize
+    dm_chunk = int(max(1, min(ndm, max_chunk_bytes // (nchan * itemsize))))
+    bin_chunk = int(max(1, min(nbin, max_chunk_bytes // (nchan * dm_chunk * itemsize))))
+    return bin_chunk, dm_chunk
+
+def iter_phase_ramps(shifts, nbin, nsamp, max_chunk_bytes=2**26, dtype=np.complex128):
+    """Iterate over chunks of the (fluctuation frequency, channel, DM trial)
+    phase ramps exp(-2πi k shift / nsamp).
+
+    Integer shifts are looked up in the table of roots of unity; fractional
+    (float) shifts are evaluated with `np.exp`.
+
+    Parameters
+    ----------
+    shifts : Numpy.Array
+        2D integer or float Array (channel, DM trial), see `get_shift_table`
+    nbin : int
+        Number of fluctuation frequency bins
+    nsamp : int
+        Number of time samples of the waterfall
+    max_chunk_bytes : int
+        Memory budget for one chunk of phase ramps (default: 64 MiB)
+    dtype : Numpy.dtype
+        Complex type of the ramps (default: complex128)
+
+    Yields
+    ------
+    bins, trials, ramps : slice, slice, Numpy.Array
+        Fluctuation frequency bins and DM trials covered by the chunk, and
+        the 3D complex Array of ramps (fluctuation frequency, channel, DM trial)
+
+    """
+    nchan, ndm = shifts.shape
+    bin_chunk, dm_chunk = get_chunk_sizes(nbin, nchan, ndm, max_chunk_bytes, dtype=dtype)
+
+    if np.issubdtype(np.asarray(shifts).dtype, np.floating):
+        shifts = np.asarray(shifts) % nsamp
+        k = np.arange(nbin)
+        for d0 in range(0, ndm, dm_chunk):
+            trials = slice(d0, min(d0 + dm_chunk, ndm))
+            for k0 in range(0, nbin, bin_chunk):
+                bins = slice(k0, min(k0 + bin_chunk, nbin))
+                phase = (k[bins, np.newaxis, np.newaxis] * shifts[np.newaxis, :, trials]) % nsamp
+                yield bins, trials, np.exp((-2j * np.pi / nsamp) * phase).astype(dtype)
+        return
+
+    twiddle = get_twiddle(nsamp, dtype=dtype)
+    # k * shift < nsamp * nbin, so indices fit in (faster) 32-bit integers
+    index_type = np.int32 if nsamp * nbin < 2**31 else np.int64
+    shifts = (np.asarray(shifts) % nsamp).astype(index_type)
+    k = np.arange(nbin, dtype=index_type)
+
+    for d0 in range(0, ndm, dm_chunk):
+        trials = slice(d0, min(d0 + dm_chunk, ndm))
+        for k0 in range(0, nbin, bin_chunk):
+            bins = slice(k0, min(k0 + bin_chunk, nbin))
+            ramps = twiddle[(k[bins, np.newaxis, np.newaxis] * shifts[np.newaxis, :, trials]) % nsamp]
+            yield bins, trials, ramps
+
+def get_spectrum_vs_dm(phasors, shifts, nsamp, max_chunk_bytes=2**26):
+    """Get the coherent spectrum for every DM trial as a batched matrix product.
+
+    For each fluctuation frequency bin k, the (1 x channel) row of phasors is
+    multiplied by the (channel x DM trial) matrix of phase ramps
+    exp(-2πi k shift / nsamp). Bins and DM trials are processed in chunks so
+    the ramps never take more than `max_chunk_bytes` of memory.
+
+    Parameters
+    ----------
+    phasors : Numpy.Array
+        2D complex Array (channel, fluctuation frequency), see `get_phasors`
+    shifts : Numpy.Array
+        2D integer Array (channel, DM trial), see `get_shift_table`
+    nsamp : int
+        Number of time samples of the waterfall
+    max_chunk_bytes : int
+        Memory budget for one chunk of phase ramps (default: 64 MiB)
+
+    Returns
+    -------
+    spectrum : Numpy.Array
+        2D complex Array (fluctuation frequency, DM trial), of the same
+        type as `phasors`
+
+    """
+    nbin = phasors.shape[1]
+    rows = np.ascontiguousarray(phasors.T)[:, np.newaxis, :]
+
+    spectrum = np.empty([nbin, shifts.shape[1]], dtype=phasors.dtype)
+    for bins, trials, ramps in iter_phase_ramps(shifts, nbin, nsamp, max_chunk_bytes,
+                                                dtype=phasors.dtype):
+        spectrum[bins, trials] = np.matmul(rows[bins], ramps)[:, 0, :]
+    return spectrum
+
+def get_d_power_vs_dm(power_vs_dm):
+    """Weight the coherent power by the squared fluctuation frequency index."""
+    omega = np.arange(0, power_vs_dm.shape[0])
+    return omega[:, np.newaxis]**2 * power_vs_dm
+
+def _get_spectrum_vs_dm_shared(name, shape, dtype, shifts, nsamp, max_chunk_bytes):
+    """`get_spectrum_vs_dm` on phasors held in the shared memory block `name`
+    (run in process pool workers)."""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        phasors = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return get_spectrum_vs_dm(phasors, shifts, nsamp, max_chunk_bytes=max_chunk_bytes)
+    finally:
+        shm.close()
+
+def map_spectrum_vs_dm(phasors, shifts, nsamp, executor=None, n_workers=None, pool='thread',
+                       dm_chunk=64, max_chunk_bytes=2**26):
+    """Get the coherent spectrum for every DM trial, one chunk of DM trials per task.
+
+    DM trials are always split in the same chunks of `dm_chunk` trials, and
+    chunks are reassembled in order, so the output is bit-identical whether
+    the chunks run serially, in a thread pool (NumPy releases the GIL) or in
+    a process pool (phasors are shared with the workers through shared memory).
+
+    Parameters
+    ----------
+    phasors : Numpy.Array
+        2D complex Array (channel, fluctuation frequency), see `get_phasors`
+    shifts : Numpy.Array
+        2D integer Array (channel, DM trial), see `get_shift_table`
+    nsamp : int
+        Number of time samples of the waterfall
+    executor : concurrent.futures.Executor
+        Executor to submit chunks to (default: None)
+    n_workers : int
+        Number of workers of the pool created when no executor is given.
+        If both are None, chunks run serially in the calling thread.
+    pool : str
+        Type of pool created from `n_workers`: 'thread' or 'process'
+    dm_chunk : int
+        Number of DM trials per chunk (default: 64)
+    max_chunk_bytes : int
+        Memory budget for one chunk of phase ramps, per worker
+
+    Returns
+    -------
+    spectrum : Numpy.Array
+        2D complex Array (fluctuation frequency, DM trial)
+
+    """
+    ndm = shifts.shape[1]
+    chunks = [slice(d0, min(d0 + dm_chunk, ndm)) for d0 in range(0, ndm, dm_chunk)]
+
+    if executor is None and n_workers is None:
+        return np.concatenate([get_spectrum_vs_dm(phasors, shifts[:, chunk], nsamp, max_chunk_bytes)
+                               for chunk in chunks], axis=1)
+
+    if executor is None:
+        if pool == 'thread':
+            new_executor = ThreadPoolExecutor(max_workers=n_workers)
+        elif pool == 'process':
+            new_executor = ProcessPoolExecutor(max_workers=n_workers)
+        else:
+            raise ValueError("`pool` must be 'thread' or 'process', got %s" % pool)
+        with new_executor:
+            return map_spectrum_vs_dm(phasors, shifts, nsamp,
+                                      executor=new_executor,
+                                      dm_chunk=dm_chunk,
+                                      max_chunk_bytes=max_chunk_bytes)
+
+    if not isinstance(executor, ProcessPoolExecutor):
+        futures = [executor.submit(get_spectrum_vs_dm, phasors, shifts[:, chunk], nsamp, max_chunk_bytes)
+                   for chunk in chunks]
+        return np.concatenate([future.result() for future in futures], axis=1)
+
+    phasors = np.ascontiguousarray(phasors)
+    shm = shared_memory.SharedMemory(create=True, size=phasors.nbytes)
+    futures = []
+    try:
+        np.ndarray(phasors.shape, dtype=phasors.dtype, buffer=shm.buf)[:] = phasors
+        for chunk in chunks:
+            futures.append(executor.submit(_get_spectrum_vs_dm_shared, shm.name, phasors.shape,
+                                           phasors.dtype, shifts[:, chunk], nsamp, max_chunk_bytes))
+        return np.concatenate([future.result() for future in futures], axis=1)
+    finally:
+        # workers attach to the block by name: if a chunk failed, cancel the
+        # chunks not started and let the running ones finish before removing it
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        shm.close()
+        shm.unlink()
+
+def get_power_vs_dm(waterfall, dm_trials, freq, dt, ref_freq="top", nbin=None,
+                    executor=None, n_workers=None, pool='thread', dm_chunk=64,
+                    max_chunk_bytes=2**26, workers=None, dtype=np.complex128, weights=None):
+    """Get the coherent power of the waterfall for every DM trial.
+
+    The output matches `get_coherent_power(dedisperse_waterfall(...))[:nbin]`
+    computed for each trial, with a single FFT of the waterfall.
+
+    Channels of zero weight are dropped before the FFT, so heavily flagged
+    bands cost proportionally less.
+
+    Parameters
+    ----------
+    waterfall : Numpy.Array
+        2D Array (channel, time)
+    dm_trials : Numpy.Array
+        DM trials (relative to the DM the waterfall is dedispersed to)
+    freq : Numpy.Array
+        Frequency of each channel (MHz)
+    dt : float
+        Sampling time (second)
+    ref_freq : str
+        Reference frequency for dedispersion ('top', 'center' or 'bottom')
+    nbin : int
+        Number of fluctuation frequency bins (default: half the number of samples)
+    executor, n_workers, pool, dm_chunk :
+        Parallel evaluation of DM trials, see `map_spectrum_vs_dm`
+    max_chunk_bytes : int
+        Memory budget for one chunk of phase ramps, see `get_spectrum_vs_dm`
+    workers, dtype :
+        FFT workers and precision (complex128 or complex64), see `get_phasors`
+    weights : Numpy.Array
+        Weight of each channel, e.g. from `get_channel_weights` (default: None,
+        i.e. all ones)
+
+    Returns
+    -------
+    power_vs_dm : Numpy.Array
+        2D Array (fluctuation frequency, DM trial)
+
+    """
+    nsamp = waterfall.shape[1]
+    if nbin is None:
+        nbin = get_nbin(nsamp)
+
+    # shifts are computed on the full band, so the reference frequency does not
+    # depend on which channels are dropped
+    shifts = get_shift_table(dm_trials, freq, dt, ref_freq=ref_freq)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        keep = weights != 0
+        waterfall, shifts, weights = waterfall[keep], shifts[keep], weights[keep]
+
+    phasors = get_phasors(waterfall, nbin, workers=workers, dtype=dtype, weights=weights)
+    spectrum = map_spectrum_vs_dm(phasors, shifts, nsamp,
+                                  executor=executor,
+                                  n_workers=n_workers,
+                                  pool=pool,
+                                  dm_chunk=dm_chunk,
+                                  max_chunk_bytes=max_chunk_bytes)
+    return np.abs(spectrum)**2
+
+class CumulativeSpectrum():
+    """Coherent spectrum vs DM accumulated over channels.
+
+    The coherent spectrum is a sum over channels, so storing its cumulative
+    sum over (blocks of `chan_step`) channels gives the spectrum of any
+    sub-band as the difference of two slices, without redoing any FFT.
+
+    Channels are shifted by their fractional (unrounded) dispersion delays,
+    so the reference frequency of the shifts only adds a phase common to all
+    channels: the power of a sub-band does not depend on it, and is that of
+    the sub-band's own channels. It is not identical to `prep_power`
+    on the sub-band, which rounds delays to whole samples: on a
+    1536-channel, 1024-sample burst, the 128-1024 sub-band differs from
+    `prep_power` by ~0.06% at fluctuation bin 1, ~2% at bin 20 and ~40% at
+    bin 200 (relative to the peak of each bin, where the rounded delays
+    decorrelate), and the DM curve of bins 0-30 by ~1%.
+
+    Memory scales as (nchan / chan_step) x nbin x len(dm_trials) complex
+    values; use `chan_step` and `dtype` to trade band resolution and precision
+    for memory.
+    """
+
+    def __init__(self, waterfall, dm_trials, freq, dt, ref_freq="top", nbin=None,
+                 chan_step=1, dtype=np.complex64, max_chunk_bytes=2**26, workers=None, weights=None):
+        """Initialise CumulativeSpectrum class.
+
+        Parameters
+        ----------
+        waterfall : Numpy.Array
+            2D Array (channel, time)
+        dm_trials : Numpy.Array
+            DM trials (relative to the DM the waterfall is dedispersed to)
+        freq : Numpy.Array
+            Frequency of each channel (MHz)
+        dt : float
+            Sampling time (second)
+        ref_freq : str
+            Reference frequency for dedispersion ('top', 'center' or 'bottom')
+        nbin : int
+            Number of fluctuation frequency bins (default: half the number of samples)
+        chan_step : int
+            Band limits resolution, in channels (default: 1)
+        dtype : Numpy.dtype
+            Complex type used to store the cumulative spectra (default: complex64)
+        max_chunk_bytes : int
+            Memory budget for one chunk of phase ramps, see `iter_phase_ramps`
+        workers : int
+            Number of workers of the FFT, see `get_phasors`
+        weights : Numpy.Array
+            Weight of each channel, see `get_power_vs_dm` (default: None)
+
+        """
+        nchan, nsamp = waterfall.shape
+        if nbin is None:
+            nbin = get_nbin(nsamp)
+
+        self.nchan = nchan
+        self.chan_step = chan_step
+        self.dm_trials = dm_trials
+        # power maps of the last band, see `power_vs_dm`
+        self._last_band = None
+        self._last_power = None
+
+        if weights is None:
+            phasors = get_phasors(waterfall, nbin, workers=workers)
+        else:
+            weights = np.asarray(weights, dtype=float)
+            keep = weights != 0
+            phasors = np.zeros([nchan, nbin], dtype=np.complex128)
+            phasors[keep] = get_phasors(waterfall[keep], nbin, workers=workers, weights=weights[keep])
+        shifts = get_shift_table(dm_trials, freq, dt, ref_freq=ref_freq, fractional=True)
+        block_starts = np.arange(0, nchan, chan_step)
+
+        self.cumulative = np.zeros([block_starts.size + 1, nbin, len(dm_trials)], dtype=dtype)
+        for bins, trials, ramps in iter_phase_ramps(shifts, nbin, nsamp, max_chunk_bytes):
+            contributions = phasors.T[bins, :, np.newaxis] * ramps
+            blocks = np.add.reduceat(contributions, block_starts, axis=1)
+            self.cumulative[1:, bins, trials] = np.cumsum(blocks, axis=1).transpose(1, 0, 2)
+
+    def block_index(self, freq_id):
+        """Index of the block boundary closest to channel `freq_id`."""
+        return int(np.clip(np.round(freq_id / self.chan_step), 0, self.cumulative.shape[0] - 1))
+
+    def spectrum(self, freq_id_low=0, freq_id_high=None):
+        """Coherent spectrum vs DM of channels [freq_id_low, freq_id_high).
+
+        Band limits are rounded to the nearest multiple of `chan_step`.
+        """
+        if freq_id_high is None:
+            freq_id_high = self.nchan
+        return (self.cumulative[self.block_index(freq_id_high)] -
+                self.cumulative[self.block_index(freq_id_low)])
+
+    def power_vs_dm(self, freq_id_low=0, freq_id_high=None):
+        """Coherent power (and its derivative weighting) vs DM of a sub-band.
+
+        Returns
+        -------
+        power_vs_dm, d_power_vs_dm : Numpy.Array, Numpy.Array
+            2D Arrays (fluctuation frequency, DM trial), as from `prep_power`.
+            The same (read-only) arrays are returned while the band does
+            not change, so that caches keyed by array (e.g. the smoothed maps
+            of `select_frequency_range`) keep hitting.
+
+        """
+        if freq_id_high is None:
+            freq_id_high = self.nchan
+        band = (self.block_index(freq_id_low), self.block_index(freq_id_high))
+        if band != self._last_band:
+            power_vs_dm = np.abs(self.spectrum(freq_id_low, freq_id_high)).astype(np.float64)**2
+            d_power_vs_dm = get_d_power_vs_dm(power_vs_dm)
+            power_vs_dm.setflags(write=False)
+            d_power_vs_dm.setflags(write=False)
+            self._last_band = band
+            self._last_power = power_vs_dm, d_power_vs_dm
+        return self._last_power
+
+    def subbands(self, width, step=None):
+        """Iterate over every sub-band of `width` channels, every `step` channels.
+
+        Yields
+        ------
+        freq_id_low, freq_id_high, power_vs_dm, d_power_vs_dm
+
+        """
+        if step is None:
+            step = width
+        for freq_id_low in range(0, self.nchan - width + 1, step):
+            freq_id_high = freq_id_low + width
+            yield (freq_id_low, freq_id_high) + self.power_vs_dm(freq_id_low, freq_id_high)
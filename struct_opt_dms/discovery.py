@@ -0,0 +1,179 @@
+'''
+Parallel recursive file discovery with a persistent index.
+
+Directory trees are walked by a thread pool (directory listings mostly
+wait on the filesystem, which releases the GIL). The listing of every
+directory (files with their size and modification time, and
+subdirectories) is kept in an index, optionally saved to a JSON file. A
+later scan only lists again the directories whose modification time
+changed, i.e. where entries were added, removed or renamed; the others cost
+a single `stat`.
+'''
+import json
+import os
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+def _list_directory(path):
+    """List a directory.
+
+    Returns
+    -------
+    listing : dict
+        'mtime_ns' of the directory, 'files' as [name, size, mtime_ns] and
+        'subdirs' names
+
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    files, subdirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files.append([entry.name, stat.st_size, stat.st_mtime_ns])
+            except OSError:
+                # entry removed while listing
+                continue
+    return {'mtime_ns': mtime_ns, 'files': sorted(files), 'subdirs': sorted(subdirs)}
+
+def matches(name, ext, substrings=[]):
+    """Whether a file name has an extension in `ext` and contains every substring in its stem."""
+    stem, extension = os.path.splitext(name)
+    return extension.lower() in ext and all(s in stem for s in substrings)
+
+class FileIndex():
+    """Index of the listings of directory trees."""
+
+    def __init__(self, filename=None):
+        """Initialise FileIndex class.
+
+        Parameters
+        ----------
+        filename : str
+            JSON file the index is loaded from (if it exists) and saved to
+            (default: None, kept in memory only)
+
+        """
+        self.filename = filename
+        self.directories = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                self.directories = json.load(f)
+        self.n_listed = 0
+
+    def _refresh(self, path):
+        """Listing of `path`, from the index if the directory did not change."""
+        known = self.directories.get(path)
+        try:
+            if known is not None and os.stat(path).st_mtime_ns == known['mtime_ns']:
+                return path, known, False
+            return path, _list_directory(path), True
+        except OSError:
+            return path, None, False
+
+    def scan(self, root, n_workers=16):
+        """Update the index of the tree under `root`.
+
+        Parameters
+        ----------
+        root : str
+            Top directory
+        n_workers : int
+            Number of threads listing directories
+
+        Returns
+        -------
+        directories : list
+            Paths of the directories of the tree (including `root`)
+
+        """
+        root = os.path.abspath(root)
+        seen = []
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            pending = {executor.submit(self._refresh, root)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, listing, listed = future.result()
+                    if listing is None:
+                        self.directories.pop(path, None)
+                        continue
+                    self.directories[path] = listing
+                    self.n_listed += listed
+                    seen.append(path)
+                    for name in listing['subdirs']:
+                        pending.add(executor.submit(self._refresh, os.path.join(path, name)))
+
+        # forget directories removed from the tree
+        prefix = os.path.join(root, '')
+        kept = set(seen)
+        for path in [p for p in self.directories if p == root or p.startswith(prefix)]:
+            if path not in kept:
+                del self.directories[path]
+
+        if self.filename is not None:
+            self.save()
+        return sorted(seen)
+
+    def save(self):
+        """Save the index to `filename` (atomically)."""
+        folder = os.path.dirname(os.path.abspath(self.filename))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, prefix='.tmp_')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.directories, f)
+        os.replace(tmp, self.filename)
+
+    def files(self, directories, ext=None, substrings=[]):
+        """Files of `directories` matching `ext` and `substrings` (see `matches`).
+
+        Returns
+        -------
+        files : list
+            (path, size, mtime_ns) of each file
+
+        """
+        found = []
+        for path in directories:
+            for name, size, mtime_ns in self.directories[path]['files']:
+                if ext is None or matches(name, ext, substrings):
+                    found.append((os.path.join(path, name), size, mtime_ns))
+        return found
+
+def find_files(folder, ext, substrings=[], index=None, n_workers=16):
+    """Find files recursively.
+
+    Parameters
+    ----------
+    folder : str
+        Top directory
+    ext : list
+        Accepted (lower case) extensions, e.g. ['.fil']
+    substrings : list
+        Substrings every file name (without extension) must contain
+    index : FileIndex or str
+        Index (or path of the JSON index file) reused across scans
+        (default: None, scan everything)
+    n_workers : int
+        Number of threads listing directories
+
+    Returns
+    -------
+    subfolders, files : list, list
+        Paths of the subdirectories of `folder` and of the matching files
+
+    """
+    if index is None or isinstance(index, str):
+        index = FileIndex(index)
+    directories = index.scan(folder, n_workers=n_workers)
+    files = [path for path, _, _ in index.files(directories, ext, substrings)]
+
+    # paths relative to `folder` as given, as os.scandir would return them
+    root = os.path.abspath(folder)
+    def as_given(path):
+        return os.path.join(folder, os.path.relpath(path, root))
+
+    return [as_given(path) for path in directories if path != root], [as_given(path) for path in files]
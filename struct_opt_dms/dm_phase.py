@@ -8,13 +8,28 @@ and provide interaction in a jupyter notebook.
 - D. Vohl, August 2020.
 '''
 import numpy as np
-from scipy.fftpack import fft, ifft
+from scipy.fft import rfft
 
-def dedisperse_waterfall(wfall, DM, freq, dt, ref_freq="top"):
-    """Dedisperse a waterfall matrix to a given DM."""
+from .shift_cache import cached_table
+
+def get_dedispersion_shift(DM, freq, dt, ref_freq="top"):
+    """Get the per-channel shift (in samples) to dedisperse to a given DM.
+
+    Shifts are cached (see shift_cache.py) and returned read-only.
+    """
+
+    return cached_table('dm_phase_shift', freq, dt, DM, ref_freq,
+                        lambda: compute_dedispersion_shift(DM, freq, dt, ref_freq=ref_freq))
+
+def compute_dedispersion_shift(DM, freq, dt, ref_freq="top"):
+    """Compute the per-channel shift (in samples) to dedisperse to a given DM."""
+
+    return compute_dedispersion_delay(DM, freq, dt, ref_freq=ref_freq).round().astype(int)
+
+def compute_dedispersion_delay(DM, freq, dt, ref_freq="top"):
+    """Compute the per-channel (fractional) delay in samples to dedisperse to a given DM."""
 
     k_DM = 1. / 2.41e-4
-    dedisp = np.zeros_like(wfall)
 
     # pick reference frequency for dedispersion
     if ref_freq == "top":
@@ -28,24 +43,73 @@ def dedisperse_waterfall(wfall, DM, freq, dt, ref_freq="top"):
         print("`ref_freq` not recognized, using 'top'")
         reference_frequency = freq[-1]
 
-    shift = (k_DM * DM * (reference_frequency**-2 - freq**-2) / dt).round().astype(int)
-    for i,ts in enumerate(wfall):
-        dedisp[i] = np.roll(ts, shift[i])
-    return dedisp
+    return k_DM * DM * (reference_frequency**-2 - freq**-2) / dt
+
+def get_dedispersion_index(shift, nsamp, out=None):
+    """Get the flat (channel, time) gather index that rolls each channel by `shift`.
+
+    Pass `out` (an integer (channel, time) Array, e.g.
+    `np.empty(waterfall.shape, dtype=np.intp)`) to fill it in place instead
+    of allocating a new index.
+    """
+
+    shift = np.asarray(shift)
+    if out is None:
+        out = np.empty([len(shift), nsamp], dtype=np.intp)
+    # (t - shift[c]) % nsamp + c * nsamp, computed in `out` without temporaries
+    np.subtract(np.arange(nsamp), shift[:, np.newaxis], out=out)
+    np.remainder(out, nsamp, out=out)
+    out += np.arange(len(shift))[:, np.newaxis] * nsamp
+    return out
+
+def dedisperse_waterfall(wfall, DM, freq, dt, ref_freq="top", out=None, index=None):
+    """Dedisperse a waterfall matrix to a given DM.
+
+    All channels are shifted at once by gathering through a (channel, time)
+    index. Only the per-channel shifts are cached: the index is as large as
+    the waterfall and would evict them during DM sweeps. Pass `out` (same
+    shape and dtype as `wfall`, not overlapping it) and `index` (an integer
+    Array of the same shape, e.g. `np.empty(wfall.shape, dtype=np.intp)`) to
+    reuse the output and index buffers between calls (e.g. over DM trials),
+    so no waterfall-sized array is allocated per call.
+    """
+
+    if out is None:
+        out = np.empty_like(wfall)
+    nsamp = wfall.shape[1]
+    shift = get_dedispersion_shift(DM, freq, dt, ref_freq=ref_freq)
+    index = get_dedispersion_index(shift, nsamp, out=index)
+    # indices are all valid: 'clip' skips bounds checking and output buffering
+    return np.take(wfall, index, out=out, mode='clip')
+
+def get_cohenrent_spectrum(waterfall, workers=None, weights=None):
+    """Get the coherent spectrum of the waterfall.
+
+    The waterfall is real, so only the non-negative fluctuation frequencies
+    (nsamp // 2 + 1 bins) are computed, with `workers` FFT workers. The FFT
+    runs in single precision for float32 waterfalls.
+
+    Per-channel `weights` (e.g. from `coherent_power.get_channel_weights`)
+    weight the phasor sum; channels of zero weight are not transformed.
+    """
 
-def get_cohenrent_spectrum(waterfall):
-    """Get the coherent spectrum of the waterfall."""
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        keep = weights != 0
+        waterfall, weights = waterfall[keep], weights[keep]
 
-    ft_waterfall = fft(waterfall)
+    ft_waterfall = rfft(waterfall, workers=workers)
     amp = np.abs(ft_waterfall)
     amp[amp == 0] = 1
+    if weights is not None:
+        amp /= weights[:, np.newaxis]
     spect = np.sum(ft_waterfall / amp, axis=0)
     return spect
 
-def get_coherent_power(waterfall):
+def get_coherent_power(waterfall, workers=None, weights=None):
     """Get the coherent power of the waterfall."""
 
-    spectra = get_cohenrent_spectrum(waterfall)
+    spectra = get_cohenrent_spectrum(waterfall, workers=workers, weights=weights)
     power = np.abs(spectra)**2
     return power
 
@@ -89,7 +153,9 @@ def fit_power(dm_trials, dm_curve, f_channels, nchan, fluct_id_low, fluct_id_hig
     snr    = (_max - d_mean) / d_std
 
     _peak  = dm_curve.argmax()
-    _range = np.arange(_peak - 5, _peak + 5)
+    # fit window of 10 trials around the peak, clipped to the grid (negative
+    # indices would wrap around to the other end)
+    _range = np.arange(max(_peak - 5, 0), min(_peak + 5, len(dm_trials)))
     y = dm_curve[_range]
     x = dm_trials[_range]
     returns_poly = poly_max(x, y, d_std)
@@ -0,0 +1,160 @@
+'''
+Coarse-to-fine search of the structure-optimised DM.
+
+Instead of evaluating a dense uniform grid of DM trials (`get_dm_trials`),
+a coarse grid is sized from the dispersion smearing of the observation, and
+trials are then added around the peak of the fitted DM curve with a finer
+step at each iteration, until the step is finer than the `poly_max`
+uncertainty of the DM.
+'''
+import numpy as np
+
+from .extern.psrpy.psr_utils import best_dm_step, dm_smear
+from .coherent_power import get_power_vs_dm, get_d_power_vs_dm
+from .dm_phase import fit_power
+
+def get_coarse_dm_step(freq, dt, dm=0., smear_factor=2.):
+    """DM step keeping the smearing across the band below `smear_factor` times
+    the intrinsic (intra-channel and sampling) smearing.
+
+    Parameters
+    ----------
+    freq : Numpy.Array
+        Frequency of each channel (MHz)
+    dt : float
+        Sampling time (second)
+    dm : float
+        Absolute DM of the data (pc/cm^3), for intra-channel smearing
+    smear_factor : float
+        Tolerated total smearing, in units of the intrinsic smearing (> 1)
+
+    Returns
+    -------
+    dm_step : float
+        DM step (pc/cm^3)
+
+    """
+    chanwidth = np.abs(np.median(np.diff(freq)))
+    center_freq = 0.5 * (np.min(freq) + np.max(freq))
+    tau_chan = dm_smear(dm, chanwidth, center_freq)
+    maxsmear = smear_factor * np.sqrt(tau_chan**2 + dt**2) * 1000.  # ms
+
+    return best_dm_step(maxsmear=maxsmear,
+                        dt=dt,
+                        dm=dm,
+                        freq=center_freq,
+                        numchan=len(freq),
+                        chanwidth=chanwidth)
+
+def fit_dm_curve(dm_trials, d_power_vs_dm, f_channels, fluct_id_low, fluct_id_high):
+    """Fit the DM curve summed over fluctuation frequencies [fluct_id_low, fluct_id_high).
+
+    Returns
+    -------
+    dm, dm_std, snr : float, float, float
+
+    """
+    dm_curve = d_power_vs_dm[fluct_id_low:fluct_id_high].sum(axis=0)
+    returns_poly, _range, snr, x, y = fit_power(dm_trials,
+                                                dm_curve,
+                                                f_channels,
+                                                len(f_channels),
+                                                fluct_id_low,
+                                                fluct_id_high)
+    return returns_poly[0], returns_poly[1], snr
+
+def adaptive_dm_search(waterfall,
+                       f_channels,
+                       dt,
+                       dm=0.,
+                       dm_range=10.,
+                       dm_step=None,
+                       min_trials=41,
+                       fluct_id_low=0,
+                       fluct_id_high=None,
+                       n_fine=21,
+                       refine_factor=5.,
+                       max_iter=5,
+                       **power_kwargs):
+    """Search the structure-optimised DM with a coarse-to-fine grid of DM trials.
+
+    Parameters
+    ----------
+    waterfall : Numpy.Array
+        2D Array (channel, time), dedispersed to `dm`
+    f_channels : Numpy.Array
+        Frequency of each channel (MHz)
+    dt : float
+        Sampling time (second)
+    dm : float
+        Absolute DM the waterfall is dedispersed to (pc/cm^3)
+    dm_range : float
+        Half-width of the coarse grid around `dm` (pc/cm^3)
+    dm_step : float
+        Step of the coarse grid (default: from `get_coarse_dm_step`, reduced
+        if needed to evaluate at least `min_trials` coarse trials)
+    min_trials : int
+        Minimum number of coarse trials when `dm_step` is not given
+    fluct_id_low, fluct_id_high : int
+        Fluctuation frequency range of the DM curve (default: all bins)
+    n_fine : int
+        Number of trials added around the peak at each refinement
+    refine_factor : float
+        Step reduction at each refinement. Refinement stops once the step
+        is smaller than the DM uncertainty (finer trials would not change
+        the measurement)
+    max_iter : int
+        Maximum number of refinements
+    power_kwargs :
+        Passed to `get_power_vs_dm` (e.g. `n_workers`)
+
+    Returns
+    -------
+    dm_trials, power_vs_dm, d_power_vs_dm, dm, dm_std :
+        Sorted (non-uniform) DM trials relative to `dm`, the power maps for
+        those trials, and the best DM (relative to `dm`) and its uncertainty
+
+    """
+    if dm_step is None:
+        dm_step = min(get_coarse_dm_step(f_channels, dt, dm=dm),
+                      2. * dm_range / (min_trials - 1))
+    if not dm_step > 0:
+        raise ValueError('Could not size the coarse DM step from the smearing, pass `dm_step`')
+
+    dm_trials = np.arange(-dm_range, dm_range + .5 * dm_step, dm_step)
+    power_vs_dm = get_power_vs_dm(waterfall, dm_trials, f_channels, dt, **power_kwargs)
+    d_power_vs_dm = get_d_power_vs_dm(power_vs_dm)
+    if fluct_id_high is None:
+        fluct_id_high = power_vs_dm.shape[0]
+
+    best, best_std, _ = fit_dm_curve(dm_trials, d_power_vs_dm, f_channels, fluct_id_low, fluct_id_high)
+    if best == 0. and best_std == 0.:
+        # no maximum found by poly_max: refine around the peak of the curve
+        best = dm_trials[d_power_vs_dm[fluct_id_low:fluct_id_high].sum(axis=0).argmax()]
+
+    for _ in range(max_iter):
+        # converged when the trials resolve the DM uncertainty (a failed fit,
+        # with no uncertainty, is always refined)
+        if dm_step < best_std:
+            break
+        dm_step /= refine_factor
+        fine_trials = best + dm_step * (np.arange(n_fine) - n_fine // 2)
+        fine_trials = fine_trials[~np.isclose(fine_trials[:, np.newaxis], dm_trials[np.newaxis, :],
+                                              rtol=0, atol=.5 * dm_step).any(axis=1)]
+        if fine_trials.size == 0:
+            break
+
+        fine_power = get_power_vs_dm(waterfall, fine_trials, f_channels, dt, **power_kwargs)
+        dm_trials = np.concatenate([dm_trials, fine_trials])
+        power_vs_dm = np.concatenate([power_vs_dm, fine_power], axis=1)
+        order = np.argsort(dm_trials)
+        dm_trials, power_vs_dm = dm_trials[order], power_vs_dm[:, order]
+        d_power_vs_dm = get_d_power_vs_dm(power_vs_dm)
+
+        new_best, new_std, _ = fit_dm_curve(dm_trials, d_power_vs_dm, f_channels, fluct_id_low, fluct_id_high)
+        if new_best == 0. and new_std == 0.:
+            # no maximum: refine around the peak of the curve
+            new_best = dm_trials[d_power_vs_dm[fluct_id_low:fluct_id_high].sum(axis=0).argmax()]
+        best, best_std = new_best, new_std
+
+    return dm_trials, power_vs_dm, d_power_vs_dm, best, best_std
@@ -2,13 +2,84 @@ import copy
 
 import numpy as np
 import scipy.signal
-from .psr_utils import rotate, delay_from_DM
+from .psr_utils import delay_from_DM
+from ...shift_cache import cached_table
+from ...statistics import median
+
+def _combine(data, axis, mode='sum', dtype=None):
+    """Sum or average 'data' along 'axis', accumulating in 'dtype'."""
+    if mode=='sum':
+        return np.sum(data, axis=axis, dtype=dtype)
+    elif mode=='mean':
+        return np.mean(data, axis=axis, dtype=dtype)
+    else:
+        raise ValueError("'mode' must be 'sum' or 'mean', got %s" % mode)
+
+def boxcar_smooth(data, widths, padval=0, out=None):
+    """Smooth 'data' along its last axis with top hats of every
+        width in 'widths', normalised such that RMS=1 after
+        smoothing (as Spectra.smooth).
+
+        The top hats are differences of a single cumulative sum,
+        so the cost does not depend on the widths.
+
+        Inputs:
+            data: Array of series to smooth (e.g. channels or
+                dedispersed profiles) along the last axis.
+            widths: Width, or list of widths, of the top hats (bins).
+            padval: Padding value to use beyond both ends of the
+                series. Possible values are float-value, 'mean',
+                'median', 'wrap'. (Default: 0)
+            out: Array to store the output in. It may be 'data'
+                itself (e.g. data[np.newaxis] for one width).
+                (Default: a new array)
+
+        Output:
+            smoothed: Array of shape (len(widths),) + data.shape.
+    """
+    data = np.asarray(data)
+    widths = np.atleast_1d(widths).astype(int)
+    assert np.all(widths >= 1)
+    nbins = data.shape[-1]
+    # the top hat of width w over bin j covers bins j-w//2 to j+(w-1)//2,
+    # the alignment of scipy.signal.convolve(..., 'same')
+    left, right = widths.max()//2, (widths.max()-1)//2
+
+    # padded series, after a leading zero for the cumulative sum
+    padded = np.empty(data.shape[:-1] + (1+left+nbins+right,))
+    padded[...,0] = 0
+    padded[...,1+left:1+left+nbins] = data
+    if padval=='wrap':
+        padded[...,1:1+left] = data[...,nbins-left:]
+        padded[...,1+left+nbins:] = data[...,:right]
+    else:
+        if padval=='mean':
+            pad = np.mean(data, axis=-1, keepdims=True)
+        elif padval=='median':
+            pad = median(data, axis=-1, keepdims=True)
+        else: # padval is a float
+            pad = padval
+        padded[...,1:1+left] = pad
+        padded[...,1+left+nbins:] = pad
+    cumulative = np.cumsum(padded, axis=-1, out=padded)
+
+    smoothed = np.empty((widths.size,) + data.shape) if out is None else out
+    for ii, width in enumerate(widths):
+        if width==1:
+            if not np.shares_memory(smoothed[ii], data):
+                smoothed[ii] = data
+            continue
+        start = left - width//2
+        np.subtract(cumulative[...,start+width:start+width+nbins],
+                    cumulative[...,start:start+nbins], out=smoothed[ii])
+        smoothed[ii] /= np.sqrt(width)
+    return smoothed
 
 class Spectra(object):
     """A class to store spectra. This is mainly to provide
         reusable functionality.
     """
-    def __init__(self, freqs, dt, data, starttime=0, dm=0):
+    def __init__(self, freqs, dt, data, starttime=0, dm=0, copy=True):
         """Spectra constructor.
 
             Inputs:
@@ -21,6 +92,9 @@ class Spectra(object):
                         with respect to the start of the observation.
                         (Default: 0).
                 dm: Dispersion measure (in pc/cm^3). (Default: 0)
+                copy: If True, store a float copy of data. If False,
+                        store data as is (e.g. a view of a memory map).
+                        (Default: True)
 
             Output:
                 spectra_obj: Spectrum object.
@@ -29,7 +103,7 @@ class Spectra(object):
         assert len(freqs)==self.numchans
 
         self.freqs = freqs
-        self.data = data.astype('float')
+        self.data = data.astype('float') if copy else data
         self.dt = dt
         self.starttime = starttime
         self.dm = 0
@@ -71,66 +145,94 @@ class Spectra(object):
             *** Shifting happens in-place ***
         """
         assert self.numchans == len(bins)
-        for ii in range(self.numchans):
+        # Get padding values of all channels at once (rotating a channel
+        # does not change its mean or median)
+        if padval=='mean':
+            pads = np.mean(self.data, axis=1)
+        elif padval=='median':
+            pads = median(self.data, axis=1)
+        elif padval!='rotate':
+            pads = np.broadcast_to(padval, self.numchans)
+
+        # Samples are moved within each channel's memory, so shifting
+        # needs no full-size temporary (only the wrapped part is buffered
+        # when rotating)
+        nspec = self.numspectra
+        for ii, shift in enumerate(np.asarray(bins)):
             chan = self.get_chan(ii)
-            # Use 'chan[:]' so update happens in-place
-            # this way the change effects self.data
-            chan[:] = rotate(chan, bins[ii])
-            if padval!='rotate':
-                # Get padding value
-                if padval=='mean':
-                    pad = np.mean(chan)
-                elif padval=='median':
-                    pad = np.median(chan)
-                else:
-                    pad = padval
-
-                # Replace rotated values with padval
-                if bins[ii]>0:
-                    chan[-bins[ii]:] = pad
-                elif bins[ii]<0:
-                    chan[:-bins[ii]] = pad
-
-    def subband(self, nsub, subdm=None, padval=0):
+            if padval=='rotate':
+                shift = shift % nspec
+                if shift:
+                    wrapped = chan[:shift].copy()
+                    chan[:nspec-shift] = chan[shift:]
+                    chan[nspec-shift:] = wrapped
+            elif shift>0:
+                shift = min(shift, nspec)
+                chan[:nspec-shift] = chan[shift:]
+                chan[nspec-shift:] = pads[ii]
+            elif shift<0:
+                shift = min(-shift, nspec)
+                chan[shift:] = chan[:nspec-shift]
+                chan[:shift] = pads[ii]
+
+    def subband(self, nsub, subdm=None, padval=0, mode='sum', dtype=None):
         """Reduce the number of channels to 'nsub' by subbanding.
             The channels within a subband are combined using the
             DM 'subdm'. 'padval' is passed to the call to
             'Spectra.shift_channels'.
 
             Inputs:
-                nsub: Number of subbands. Must be a factor of
-                    the number of channels.
+                nsub: Number of subbands. If it is not a factor of
+                    the number of channels, the excess channels at
+                    the end of the band are trimmed off.
                 subdm: The DM with which to combine channels within
                     each subband (Default: don't shift channels
                     within each subband)
                 padval: The padding value to use when shifting
                     channels during dedispersion. See documentation
                     of Spectra.shift_channels. (Default: 0)
+                mode: Combine the channels of a subband with their
+                    'sum' or 'mean'. (Default: 'sum')
+                dtype: Type used to accumulate (and store) the
+                    subbands, e.g. 'float32'. (Default: type of the data)
 
             Outputs:
                 None
 
             *** Subbanding happens in-place ***
         """
-        assert (self.numchans % nsub) == 0
+        nsub = int(nsub)
+        if not 1 <= nsub <= self.numchans:
+            raise ValueError("'nsub' must be between 1 and the number of channels (%d), got %d"
+                             % (self.numchans, nsub))
         assert (subdm is None) or (subdm >= 0)
-        nchan_per_sub = self.numchans/nsub
+        num_to_trim = self.numchans % nsub
+        if num_to_trim:
+            self.data = self.data[:-num_to_trim]
+            self.freqs = self.freqs[:-num_to_trim]
+            self.numchans = self.numchans-num_to_trim
+        nchan_per_sub = self.numchans//nsub
         sub_hifreqs = self.freqs[np.arange(int(nsub))*int(nchan_per_sub)]
         sub_lofreqs = self.freqs[(1+np.arange(int(nsub)))*int(nchan_per_sub-1)]
         sub_ctrfreqs = 0.5*(sub_hifreqs+sub_lofreqs)
 
         if subdm is not None:
-            # Compute delays
-            ref_delays = delay_from_DM(subdm-self.dm, sub_ctrfreqs)
-            delays = delay_from_DM(subdm-self.dm, self.freqs)
-            rel_delays = delays-ref_delays.repeat(nchan_per_sub) # Relative delay
-            rel_bindelays = np.round(rel_delays/self.dt).astype('int')
+            def compute_bindelays():
+                # Compute delays
+                ref_delays = delay_from_DM(subdm-self.dm, sub_ctrfreqs)
+                delays = delay_from_DM(subdm-self.dm, self.freqs)
+                rel_delays = delays-ref_delays.repeat(nchan_per_sub) # Relative delay
+                return np.round(rel_delays/self.dt).astype('int')
+
+            rel_bindelays = cached_table('psrpy_subband', self.freqs, self.dt,
+                                         subdm-self.dm, ('subband', nsub),
+                                         compute_bindelays)
             # Shift channels
             self.shift_channels(rel_bindelays, padval)
 
         # Subband
-        self.data = np.array([np.sum(sub, axis=0) for sub in \
-                                np.vsplit(self.data, nsub)])
+        self.data = _combine(self.data.reshape(nsub, -1, self.numspectra),
+                             1, mode, dtype)
         self.freqs = sub_ctrfreqs
         self.numchans = nsub
 
@@ -149,14 +251,12 @@ class Spectra(object):
                     Spectra object.
         """
         other = copy.deepcopy(self)
-        if not indep:
+        if indep:
+            std = other.data.std(axis=1, keepdims=True)
+        else:
             std = other.data.std()
-        for ii in range(other.numchans):
-            chan = other.get_chan(ii)
-            median = np.median(chan)
-            if indep:
-                std = chan.std()
-            chan[:] = (chan-median)/std
+        other.data -= median(other.data, axis=1, keepdims=True)
+        other.data /= std
         return other
 
     def scaled2(self, indep=False):
@@ -204,21 +304,17 @@ class Spectra(object):
                 maskedspec: A masked version of the Spectra object.
         """
         assert self.data.shape == mask.shape
-        maskvals = np.ones(self.numchans)
-        for ii in range(self.numchans):
-            chan = self.get_chan(ii)
-            # Use 'chan[:]' so update happens in-place
-            if maskval=='mean':
-                maskvals[ii]=np.mean(chan)
-            elif maskval=='median':
-                maskvals[ii]=np.median(chan)
-            elif maskval=='median-mid80':
-                n = int(np.round(0.1*self.numspectra))
-                maskvals[ii]=np.median(sorted(chan)[n:-n])
-            else:
-                maskvals[ii]=maskval
-            if np.all(mask[ii]):
-                self.data[ii] = np.ones_like(self.data[ii])*(maskvals[:,np.newaxis][ii])
+        # only fully masked channels are replaced
+        chans = np.flatnonzero(np.all(mask, axis=1))
+        if maskval=='mean':
+            maskvals = np.mean(self.data[chans], axis=1)
+        elif maskval in ('median', 'median-mid80'):
+            # trimming the same number of values at both ends of a
+            # channel does not change its median
+            maskvals = median(self.data[chans], axis=1)
+        else:
+            maskvals = np.full(chans.size, maskval)
+        self.data[chans] = maskvals[:, np.newaxis]
         return self
 
     def dedisperse(self, dm=0, padval=0):
@@ -237,10 +333,14 @@ class Spectra(object):
             *** Dedispersion happens in place ***
         """
         assert dm >= 0
-        ref_delay = delay_from_DM(dm-self.dm, np.max(self.freqs))
-        delays = delay_from_DM(dm-self.dm, self.freqs)
-        rel_delays = delays-ref_delay # Relative delay
-        rel_bindelays = np.round(rel_delays/self.dt).astype('int')
+        def compute_bindelays():
+            ref_delay = delay_from_DM(dm-self.dm, np.max(self.freqs))
+            delays = delay_from_DM(dm-self.dm, self.freqs)
+            rel_delays = delays-ref_delay # Relative delay
+            return np.round(rel_delays/self.dt).astype('int')
+
+        rel_bindelays = cached_table('psrpy_dedisperse', self.freqs, self.dt,
+                                     dm-self.dm, 'max', compute_bindelays)
         # Shift channels
         self.shift_channels(rel_bindelays, padval)
 
@@ -261,33 +361,19 @@ class Spectra(object):
             Ouputs:
                 None
 
-            This bit of code is taken from Scott Ransom's
-            PRESTO's single_pulse_search.py (line ~ 423).
+            This bit of code is adapted from Scott Ransom's
+            PRESTO's single_pulse_search.py (line ~ 423), with
+            every channel smoothed at once (see boxcar_smooth).
 
-            *** Smoothing is done in place. ***
+            *** Smoothing is done in place for float data. Integer
+                data (e.g. a memory-mapped file) are replaced by
+                smoothed float data. ***
         """
         if width > 1:
-            kernel = np.ones(width, dtype='float32')/np.sqrt(width)
-            for ii in range(self.numchans):
-                chan = self.get_chan(ii)
-                if padval=='wrap':
-                    tosmooth = np.concatenate([chan[-width:], \
-                                chan, chan[:width]])
-                elif padval=='mean':
-                    tosmooth = np.ones(self.numspectra+width*2) * \
-                                np.mean(chan)
-                    tosmooth[width:-width] = chan
-                elif padval=='median':
-                    tosmooth = np.ones(self.numspectra+width*2) * \
-                                np.median(chan)
-                    tosmooth[width:-width] = chan
-                else: # padval is a float
-                    tosmooth = np.ones(self.numspectra+width*2) * \
-                                padval
-                    tosmooth[width:-width] = chan
-
-                smoothed = scipy.signal.convolve(tosmooth, kernel, 'same')
-                chan[:] = smoothed[width:-width]
+            if np.issubdtype(self.data.dtype, np.floating):
+                boxcar_smooth(self.data, width, padval, out=self.data[np.newaxis])
+            else:
+                self.data = boxcar_smooth(self.data, width, padval)[0]
 
     def trim(self, bins=0):
         """Trim the end of the data by 'bins' spectra.
@@ -313,26 +399,38 @@ class Spectra(object):
             self.numspectra = self.numspectra-bins
             self.starttime = self.starttime+bins*self.dt
 
-    def downsample(self, factor=1, trim=True):
+    def downsample(self, factor=1, trim=True, mode='sum', dtype=None):
         """Downsample (in-place) the spectra by co-adding
             'factor' adjacent bins.
 
             Inputs:
                 factor: Reduce the number of spectra by this
-                    factor. Must be a factor of the number of
-                    spectra if 'trim' is False.
-                trim: Trim off excess bins.
+                    factor. If it is not a factor of the number of
+                    spectra, the excess bins at the end are trimmed
+                    off.
+                trim: Unused, excess bins are always trimmed.
+                    (Kept for compatibility)
+                mode: Combine adjacent bins with their 'sum'
+                    or 'mean'. (Default: 'sum')
+                dtype: Type used to accumulate (and store) the
+                    downsampled spectra, e.g. 'float32'.
+                    (Default: type of the data)
 
             Ouputs:
                 None
 
             *** Downsampling is done in place ***
         """
-        assert trim or not (self.numspectra % factor)
+        factor = int(factor)
+        if not 1 <= factor <= self.numspectra:
+            raise ValueError("'factor' must be between 1 and the number of spectra (%d), got %d"
+                             % (self.numspectra, factor))
         new_num_spectra = self.numspectra // factor
         num_to_trim = int(self.numspectra % factor)
         self.trim(num_to_trim)
-        self.data = np.array(np.column_stack([np.sum(subint, axis=1) for \
-                        subint in np.hsplit(self.data,new_num_spectra)]))
+        # Splitting the time axis is a view, even of a memory map,
+        # so the data are read only once
+        self.data = _combine(self.data.reshape(self.numchans, new_num_spectra, factor),
+                             2, mode, dtype)
         self.numspectra = new_num_spectra
         self.dt = self.dt*factor
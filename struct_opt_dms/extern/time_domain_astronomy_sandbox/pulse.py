@@ -1,6 +1,7 @@
 """Pulse class."""
 import numpy as np
 from .backend import Backend
+from ...shift_cache import cached_table
 from ipywidgets import interact
 import ipywidgets as widgets
 from matplotlib import pyplot as plt
@@ -42,10 +43,15 @@ class Pulse():
         Returns
         -------
         delays:Numpy.array
-            Array of delays (in second)
+            Array of delays (in second), cached and read-only
 
         """
-        return np.array([self.dt(dm, f) for f in self.backend.frequencies])
+        return cached_table('pulse_delays',
+                            self.backend.frequencies,
+                            self.backend.sampling_time,
+                            dm,
+                            self.backend.fmax,
+                            lambda: [self.dt(dm, f) for f in self.backend.frequencies])
 
     def plot_delay_v_frequency(self, dm, xscale='linear',
                                savefig=False, ext='png'):
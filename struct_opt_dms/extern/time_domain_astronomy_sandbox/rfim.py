@@ -1,25 +1,64 @@
 """RFIm class."""
 import numpy as np
 
+from ...statistics import median
+
+
+def pack_mask(mask):
+    """Pack a 2D boolean mask (channel, time) into bits along time."""
+    return np.packbits(mask, axis=-1)
+
+def unpack_mask(packed_mask, nsamp):
+    """Unpack a mask packed with `pack_mask` for `nsamp` time samples."""
+    return np.unpackbits(packed_mask, axis=-1, count=nsamp).astype(bool)
 
 class RFIm():
-    """RFIm class. A class for radio interference mitigation."""
+    """RFIm class. A class for radio interference mitigation.
+
+    Every cleaning method takes `replace` and `return_mask` arguments:
+        replace : bool
+            Replace flagged samples in `data` (in place) (default: True).
+            If False, `data` is left untouched (with n_iter > 1, iterations
+            run on an internal copy).
+        return_mask : bool
+            Also return the bit-packed mask of flagged samples (see
+            `pack_mask`/`unpack_mask`), as `data, packed_mask`.
+    """
 
     def __init__(self):
         """Initialise RFIm class."""
         pass
 
-    def dm0clean(self, data, threshold=3.25):
+    def _workspace(self, data, replace, n_iter=1):
+        """Array cleaned across iterations (None if nothing needs replacing)."""
+        if replace:
+            return data
+        if n_iter > 1:
+            return data.copy()
+        return None
+
+    def _output(self, data, mask, return_mask):
+        if return_mask:
+            return data, pack_mask(mask)
+        return data
+
+    def dm0clean(self, data, threshold=3.25, replace=True, return_mask=False):
         dtmean = np.mean(data, axis=1)
         dfmean = np.mean(data, axis=0)
         stdevf = np.std(dfmean)
-        medf = np.median(dfmean)
+        medf = median(dfmean)
         maskf = np.where(np.abs(dfmean - medf) > threshold*stdevf)[0]
         # replace with mean spectrum
-        data[:, maskf] = dtmean[:, None]*np.ones(len(maskf))[None]
-        return data
+        if replace:
+            data[:, maskf] = dtmean[:, None]*np.ones(len(maskf))[None]
 
-    def fdsc(self, data, bin_size=32, threshold=2.75):
+        mask = None
+        if return_mask:
+            mask = np.zeros(data.shape, dtype=bool)
+            mask[:, maskf] = True
+        return self._output(data, mask, return_mask)
+
+    def fdsc(self, data, bin_size=32, threshold=2.75, replace=True, return_mask=False):
         """Frequency domain sigma cut.
 
         (Modified code from https://github.com/liamconnor/arts-analysis/blob/master/triggers.py)
@@ -39,10 +78,16 @@ class RFIm():
         stdevt = np.std(dtmean_nobandpass)
         medt = np.mean(dtmean_nobandpass)
         maskt = np.abs(dtmean_nobandpass - medt) > threshold*stdevt
-        data[maskt] = np.median(dtmean)
-        return data
+        if replace:
+            data[maskt] = median(dtmean)
+
+        mask = None
+        if return_mask:
+            mask = np.zeros(data.shape, dtype=bool)
+            mask[maskt] = True
+        return self._output(data, mask, return_mask)
 
-    def fdsc_old(self, data, bin_size=32, threshold=2.75, n_iter=1):
+    def fdsc_old(self, data, bin_size=32, threshold=2.75, n_iter=1, replace=True, return_mask=False):
         """Frequency domain sigma cut.
 
         Parameters
@@ -57,21 +102,28 @@ class RFIm():
             Number of cleaning iteration
 
         """
+        work = self._workspace(data, replace, n_iter)
+        source = data if work is None else work
+        mask = np.zeros(data.shape, dtype=bool) if return_mask else None
         for j in range(n_iter):
-            dtmean = np.mean(data, axis=-1)
+            dtmean = np.mean(source, axis=-1)
             for i in range(data.shape[1]):
-                dtmean_nobandpass = data[:, i] - dtmean.reshape(-1, bin_size).mean(-1).repeat(bin_size)
+                dtmean_nobandpass = source[:, i] - dtmean.reshape(-1, bin_size).mean(-1).repeat(bin_size)
                 stdevt = np.std(dtmean_nobandpass)
                 # medt = np.median(dtmean_nobandpass)
                 medt = np.mean(dtmean_nobandpass)
                 maskt = np.abs(dtmean_nobandpass - medt) > threshold*stdevt
 
                 # replace with mean bin values
-                data[maskt, i] = dtmean.reshape(-1, bin_size).mean(-1).repeat(bin_size)[maskt]
+                if work is not None:
+                    work[maskt, i] = dtmean.reshape(-1, bin_size).mean(-1).repeat(bin_size)[maskt]
+                if mask is not None:
+                    mask[maskt, i] = True
 
-        return data
+        return self._output(data, mask, return_mask)
 
-    def fdsc_amber(self, data, bin_size=32, threshold=2.75, n_iter=1, symetric=False):
+    def fdsc_amber(self, data, bin_size=32, threshold=2.75, n_iter=1, symetric=False,
+                   replace=True, return_mask=False):
         """Frequency domain sigma cut.
 
         Parameters
@@ -84,27 +136,42 @@ class RFIm():
             Threshold to use for sigma cut inequality
         n_iter : int
             Number of cleaning iteration
+        symetric : bool
+            Also cut values below the mean
+
+        Every time sample is cleaned independently, so all of them are
+        processed at once. Cleaning happens in place (float32 data stays
+        float32).
 
         """
+        work = self._workspace(data, replace, n_iter)
+        source = data if work is None else work
+        mask = np.zeros(data.shape, dtype=bool) if return_mask else None
         for k in range(n_iter):
-            for t in range(data.shape[1]):
-                current = data[:, t]
-                dtmean_nobandpass = current - current.reshape(-1, bin_size).mean(-1).repeat(bin_size)
-                stdevt = np.std(dtmean_nobandpass)
-                # medt = np.median(dtmean_nobandpass)
-                medt = np.mean(dtmean_nobandpass)
-
-                if symetric:
-                    maskt = np.abs(dtmean_nobandpass-medt) > threshold*stdevt
-                else:
-                    maskt = dtmean_nobandpass > medt + threshold*stdevt
-
-                # replace with mean bin values
-                data[maskt, t] = current.reshape(-1, bin_size).mean(-1).repeat(bin_size)[maskt]
-
-        return data
-
-    def tdsc(self, data, threshold=3.25, n_iter=1):
+            # (time, bin, channel in bin): per time sample reductions run over
+            # contiguous memory, in the same order as on a single spectrum
+            binned = np.ascontiguousarray(source.T).reshape(data.shape[1], -1, bin_size)
+            bin_mean = binned.mean(axis=-1, keepdims=True)
+            dtmean_nobandpass = (binned - bin_mean).reshape(data.shape[1], -1)
+            stdevt = np.std(dtmean_nobandpass, axis=-1, keepdims=True)
+            # medt = np.median(dtmean_nobandpass)
+            medt = np.mean(dtmean_nobandpass, axis=-1, keepdims=True)
+
+            if symetric:
+                maskt = np.abs(dtmean_nobandpass-medt) > threshold*stdevt
+            else:
+                maskt = dtmean_nobandpass > medt + threshold*stdevt
+
+            # replace with mean bin values
+            if work is not None:
+                bin_mean = np.broadcast_to(bin_mean, binned.shape).reshape(data.shape[1], -1)
+                np.copyto(work, bin_mean.T, where=maskt.T)
+            if mask is not None:
+                mask |= maskt.T
+
+        return self._output(data, mask, return_mask)
+
+    def tdsc(self, data, threshold=3.25, n_iter=1, replace=True, return_mask=False):
         """Time domain sigma cut.
 
         (Modified code from https://github.com/liamconnor/arts-analysis/blob/master/triggers.py)
@@ -121,18 +188,25 @@ class RFIm():
             Number of cleaning iteration
 
         """
+        work = self._workspace(data, replace, n_iter)
+        source = data if work is None else work
+        mask = np.zeros(data.shape, dtype=bool) if return_mask else None
         dtmean = np.mean(data, axis=-1)
         for i in range(n_iter):
-            dfmean = np.mean(data, axis=0)
+            dfmean = np.mean(source, axis=0)
             stdevf = np.std(dfmean)
-            medf = np.median(dfmean)
+            medf = median(dfmean)
             maskf = np.where(np.abs(dfmean - medf) > threshold*stdevf)[0]
             # replace with mean spectrum
-            data[:, maskf] = dtmean[:, None]*np.ones(len(maskf))[None]
+            if work is not None:
+                work[:, maskf] = dtmean[:, None]*np.ones(len(maskf))[None]
+            if mask is not None:
+                mask[:, maskf] = True
 
-        return data
+        return self._output(data, mask, return_mask)
 
-    def tdsc_amber(self, data, threshold=3.25, n_iter=1, symetric=False):
+    def tdsc_amber(self, data, threshold=3.25, n_iter=1, symetric=False,
+                   replace=True, return_mask=False):
         """Time domain sigma cut as implemented in AA-ALERT RFIm.
 
         Parameters
@@ -145,23 +219,34 @@ class RFIm():
             Threshold to use for sigma cut inequality
         n_iter : int
             Number of cleaning iteration
+        symetric : bool
+            Also cut values below the mean
+
+        Every channel is cleaned independently, so all of them are
+        processed at once. Cleaning happens in place (float32 data stays
+        float32).
 
         """
+        work = self._workspace(data, replace, n_iter)
+        source = data if work is None else work
+        mask = np.zeros(data.shape, dtype=bool) if return_mask else None
         for k in range(n_iter):
-            for f in range(data.shape[0]):
-                dfmean = np.mean(data[f, :])
-                stdevf  = np.std(data[f, :])
+            dfmean = np.mean(source, axis=1, keepdims=True)
+            stdevf = np.std(source, axis=1, keepdims=True)
 
-                if symetric:
-                    maskf = np.where(np.abs(data[f, :] - dfmean) > threshold*stdevf)[0]
-                else:
-                    maskf = np.where(data[f, :] > dfmean + threshold*stdevf)[0]
+            if symetric:
+                maskf = np.abs(source - dfmean) > threshold*stdevf
+            else:
+                maskf = source > dfmean + threshold*stdevf
 
-                data[f, maskf] = dfmean
+            if work is not None:
+                np.copyto(work, dfmean, where=maskf)
+            if mask is not None:
+                mask |= maskf
 
-        return data
+        return self._output(data, mask, return_mask)
 
-    def tdsc_per_channel(self, data, threshold=3.25, n_iter=1):
+    def tdsc_per_channel(self, data, threshold=3.25, n_iter=1, replace=True, return_mask=False):
         """Time domain sigma cut.
 
         (Code from https://github.com/liamconnor/arts-analysis/blob/master/triggers.py)
@@ -178,13 +263,19 @@ class RFIm():
             Number of cleaning iteration
 
         """
+        work = self._workspace(data, replace, n_iter)
+        source = data if work is None else work
+        mask = np.zeros(data.shape, dtype=bool) if return_mask else None
         for ii in range(n_iter):
-            dtmean = np.mean(data, axis=1, keepdims=True)
-            dtsig = np.std(data, axis=1)
+            dtmean = np.mean(source, axis=1, keepdims=True)
+            dtsig = np.std(source, axis=1)
             for nu in range(data.shape[0]):
                 d = dtmean[nu]
                 sig = dtsig[nu]
-                maskpc = np.where(np.abs(data[nu]-d)>threshold*sig)[0]
-                data[nu][maskpc] = d
+                maskpc = np.where(np.abs(source[nu]-d)>threshold*sig)[0]
+                if work is not None:
+                    work[nu][maskpc] = d
+                if mask is not None:
+                    mask[nu][maskpc] = True
 
-        return data
+        return self._output(data, mask, return_mask)
@@ -0,0 +1,179 @@
+'''
+Resumable multi-process burst farm.
+
+Bursts are fanned out over a process pool with at most one burst in flight
+per worker, so each worker only ever holds one cropped waterfall. Failed
+bursts are retried, and every finished attempt is appended to a JSON lines
+journal, so an interrupted run (or a dead node) restarts with only the
+bursts that have not finished yet.
+
+Usage:
+    python -m struct_opt_dms.farm bursts.csv results.csv --journal run.jsonl --n-processes 8
+'''
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from .batch import _process_burst, get_parser, read_bursts, write_results
+from .catalogue import ResultsCatalogue
+
+def burst_key(burst):
+    """Identifier of a burst in the journal."""
+    return '%s|%s|%r' % (burst['burst_id'], os.path.abspath(burst['filename']), float(burst['dm']))
+
+def _to_json(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+class Journal():
+    """Append-only JSON lines record of the attempts of every burst."""
+
+    def __init__(self, filename):
+        """Initialise Journal class.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the journal (created if needed, appended to otherwise)
+
+        """
+        self.filename = filename
+        self.records = {}
+        self.attempts = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # partial line written when the run was killed
+                        continue
+                    self.records[record['key']] = record
+                    self.attempts[record['key']] = record['attempt']
+
+    def append(self, key, result):
+        """Record an attempt of burst `key` with its `result`."""
+        attempt = self.attempts.get(key, 0) + 1
+        record = {'key': key,
+                  'attempt': attempt,
+                  'result': {k: _to_json(v) for k, v in result.items()}}
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.records[key] = record
+        self.attempts[key] = attempt
+
+    def is_finished(self, key, max_retries):
+        """Whether burst `key` succeeded, was measured without a DM maximum
+        (retrying gives the same result), or failed `max_retries` + 1 times."""
+        if key not in self.records:
+            return False
+        status = self.records[key]['result']['status']
+        return (status == 'ok' or status.startswith('failed') or
+                self.attempts[key] > max_retries)
+
+    def results(self, bursts):
+        """Last recorded result of each burst (in the order of `bursts`)."""
+        return [self.records[burst_key(burst)]['result'] for burst in bursts
+                if burst_key(burst) in self.records]
+
+def run_farm(bursts,
+             journal_filename,
+             n_processes=None,
+             max_retries=2,
+             max_tasks_per_child=None,
+             **kwargs):
+    """Process the unfinished bursts of a journal in a process pool.
+
+    Parameters
+    ----------
+    bursts : list
+        Bursts, see `batch.read_bursts`
+    journal_filename : str
+        Path to the JSON lines journal of the run
+    n_processes : int
+        Number of processes (default: number of CPUs)
+    max_retries : int
+        Number of times a failed burst is tried again (also across runs)
+    max_tasks_per_child : int
+        Restart workers after this many bursts, to return their memory
+        (default: None, never)
+    kwargs :
+        Passed to `batch.process_burst`
+
+    Returns
+    -------
+    journal : Journal
+        Journal holding the result of every processed burst
+
+    """
+    journal = Journal(journal_filename)
+    queue = [burst for burst in bursts if not journal.is_finished(burst_key(burst), max_retries)]
+    queue.reverse()
+    n_processes = n_processes or os.cpu_count()
+    pool_kwargs = {} if max_tasks_per_child is None else {'max_tasks_per_child': max_tasks_per_child}
+
+    while queue:
+        running = {}
+        try:
+            with ProcessPoolExecutor(max_workers=n_processes, **pool_kwargs) as executor:
+                while queue or running:
+                    # one burst in flight per worker
+                    while queue and len(running) < n_processes:
+                        future = executor.submit(_process_burst, queue[-1], kwargs)
+                        running[future] = queue.pop()
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result = future.result()
+                        burst = running.pop(future)
+                        key = burst_key(burst)
+                        journal.append(key, result)
+                        if not journal.is_finished(key, max_retries):
+                            queue.insert(0, burst)
+        except BrokenProcessPool:
+            # a worker died (e.g. killed when running out of memory): the
+            # bursts in flight count as failed attempts, and a new pool starts
+            for burst in running.values():
+                key = burst_key(burst)
+                journal.append(key, {'burst_id': burst['burst_id'],
+                                     'filename': burst['filename'],
+                                     'estimated_dm': burst['dm'],
+                                     'status': 'error: worker process died',
+                                     'time': time.time()})
+                if not journal.is_finished(key, max_retries):
+                    queue.insert(0, burst)
+
+    return journal
+
+def main(argv=None):
+    parser = get_parser()
+    parser.prog = 'python -m struct_opt_dms.farm'
+    parser.description = 'Measure structure-optimised DMs of many bursts, resumably.'
+    parser.add_argument('--journal', required=True,
+                        help='JSON lines journal of the run (rerun with the same journal to resume)')
+    parser.add_argument('--max-retries', type=int, default=2)
+    parser.add_argument('--max-tasks-per-child', type=int, default=None)
+    args = vars(parser.parse_args(argv))
+
+    bursts = read_bursts(args.pop('bursts'), dm=args.pop('dm'))
+    output = args.pop('output')
+    catalogue = args.pop('catalogue')
+    journal = run_farm(bursts,
+                       args.pop('journal'),
+                       n_processes=args.pop('n_processes'),
+                       max_retries=args.pop('max_retries'),
+                       max_tasks_per_child=args.pop('max_tasks_per_child'),
+                       **args)
+
+    n_ok, n_failed = write_results(journal.results(bursts), output,
+                                   None if catalogue is None else ResultsCatalogue(catalogue))
+    print ('%d bursts processed, %d failed. Results in %s' % (n_ok, n_failed, output))
+    return 1 if n_failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
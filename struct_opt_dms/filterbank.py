@@ -0,0 +1,214 @@
+'''
+Memory-mapped SIGPROC filterbank reader.
+
+The header is parsed natively and the data are memory mapped, so reading a
+time window and a channel range only touches the corresponding bytes of the
+file, instead of loading the whole file (as `blimpy.Waterfall` does) and
+cropping it afterwards.
+'''
+import struct
+
+import numpy as np
+
+from .extern.psrpy.spectra import Spectra
+from .statistics import median
+
+# Type of the value following each SIGPROC header keyword
+HEADER_TYPES = {
+    'telescope_id': 'i', 'machine_id': 'i', 'data_type': 'i', 'barycentric': 'i',
+    'pulsarcentric': 'i', 'nbits': 'i', 'nsamples': 'i', 'nchans': 'i', 'nifs': 'i',
+    'nbeams': 'i', 'ibeam': 'i',
+    'tstart': 'd', 'tsamp': 'd', 'fch1': 'd', 'foff': 'd', 'refdm': 'd', 'period': 'd',
+    'az_start': 'd', 'za_start': 'd', 'src_raj': 'd', 'src_dej': 'd',
+    'source_name': 'str', 'rawdatafile': 'str',
+    'signed': 'b',
+}
+
+def _read_string(f):
+    length, = struct.unpack('<i', f.read(4))
+    if not 0 < length < 256:
+        raise ValueError('Invalid SIGPROC header string length %d' % length)
+    return f.read(length).decode('ascii', errors='replace')
+
+def read_header(filename):
+    """Parse the header of a SIGPROC filterbank file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the filterbank file
+
+    Returns
+    -------
+    header : dict
+        Header keywords and values
+    header_size : int
+        Size of the header in bytes (offset of the data)
+
+    """
+    header = {}
+    with open(filename, 'rb') as f:
+        if _read_string(f) != 'HEADER_START':
+            raise ValueError('%s is not a SIGPROC filterbank file' % filename)
+        while True:
+            keyword = _read_string(f)
+            if keyword == 'HEADER_END':
+                break
+            if keyword not in HEADER_TYPES:
+                raise ValueError('Unknown SIGPROC header keyword %s' % keyword)
+            value_type = HEADER_TYPES[keyword]
+            if value_type == 'str':
+                header[keyword] = _read_string(f)
+            else:
+                size = struct.calcsize(value_type)
+                header[keyword], = struct.unpack('<' + value_type, f.read(size))
+        header_size = f.tell()
+    return header, header_size
+
+def _write_string(f, string):
+    f.write(struct.pack('<i', len(string)))
+    f.write(string.encode('ascii'))
+
+def write_header(f, header):
+    """Write a SIGPROC header to the binary file object `f`.
+
+    Returns
+    -------
+    header_size : int
+        Size of the header in bytes
+
+    """
+    start = f.tell()
+    _write_string(f, 'HEADER_START')
+    for keyword, value in header.items():
+        value_type = HEADER_TYPES[keyword]
+        _write_string(f, keyword)
+        if value_type == 'str':
+            _write_string(f, value)
+        else:
+            f.write(struct.pack('<' + value_type, value))
+    _write_string(f, 'HEADER_END')
+    return f.tell() - start
+
+def get_data_type(header):
+    """Numpy type of the samples described by `header`."""
+    nbits = header.get('nbits', 8)
+    if nbits == 8:
+        return np.int8 if header.get('signed', 0) else np.uint8
+    if nbits == 16:
+        return np.uint16
+    if nbits == 32:
+        return np.float32
+    raise ValueError('Unsupported number of bits per sample: %d' % nbits)
+
+def open_filterbank(filename, mode='r'):
+    """Memory map the data of a SIGPROC filterbank file.
+
+    Returns
+    -------
+    header : dict
+        Header keywords and values
+    data : Numpy.memmap
+        3D Array (time, IF, channel) in file order
+    header_size : int
+        Size of the header in bytes
+
+    """
+    header, header_size = read_header(filename)
+    dtype = np.dtype(get_data_type(header))
+    nchans = header['nchans']
+    nifs = header.get('nifs', 1)
+
+    with open(filename, 'rb') as f:
+        f.seek(0, 2)
+        nbytes = f.tell() - header_size
+    nsamples = nbytes // (nchans * nifs * dtype.itemsize)
+
+    data = np.memmap(filename, dtype=dtype, mode=mode, offset=header_size,
+                     shape=(nsamples, nifs, nchans))
+    return header, data, header_size
+
+def get_frequencies(header):
+    """Frequency of each channel (MHz), in ascending order."""
+    freqs = header['fch1'] + header['foff'] * np.arange(header['nchans'])
+    return freqs[::-1] if header['foff'] < 0 else freqs
+
+def find_peak(data, block_size=2**14):
+    """Time sample of the peak of the median (over channels) time series,
+    computed block by block to keep memory constant."""
+    peak_ind, peak_val = 0, -np.inf
+    for start in range(0, data.shape[0], block_size):
+        series = median(data[start:start + block_size, 0, :], axis=1)
+        if series.max() > peak_val:
+            peak_ind, peak_val = start + int(series.argmax()), series.max()
+    return peak_ind
+
+def read_filterbank_window(filename,
+                           t_start=None,
+                           t_zoom=None,
+                           peak_sample=None,
+                           around_peak=False,
+                           freq_id_low=0,
+                           freq_id_high=None,
+                           copy=False):
+    """Read a time window and channel range of a filterbank file.
+
+    Only the bytes of the requested window are read, unless `around_peak`
+    is True (the whole file is then scanned, block by block, for the peak).
+
+    Parameters
+    ----------
+    filename : str
+        Path to the filterbank file
+    t_start : float
+        Start of the window (second) (default: start of the file, or centred
+        on the peak)
+    t_zoom : float
+        Length of the window (second) (default: until the end of the file)
+    peak_sample : int
+        Centre the window on this time sample
+    around_peak : bool
+        Centre the window on the peak of the median time series
+    freq_id_low, freq_id_high : int
+        Channel range, in ascending frequency order (default: all channels)
+    copy : bool
+        If False, Spectra.data is a view of a copy-on-write memory map (in
+        the file's sample type): in-place processing (e.g.
+        `Spectra.dedisperse`) only copies the pages it modifies into memory
+        and never writes to the file. If True, it is a float array in memory.
+
+    Returns
+    -------
+    spectra : Spectra
+        Channels in ascending frequency order (as `processing.read_filterbank`)
+
+    """
+    header, data, _ = open_filterbank(filename, mode='c')
+    nsamples, _, nchans = data.shape
+    dt = header['tsamp']
+
+    n_samp = nsamples if t_zoom is None else int(np.round(t_zoom / dt))
+    if around_peak and peak_sample is None:
+        peak_sample = find_peak(data)
+    if peak_sample is not None:
+        start = int(np.round(peak_sample - 0.5 * n_samp))
+    elif t_start is not None:
+        start = int(np.round(t_start / dt))
+    else:
+        start = 0
+    if start < 0:
+        n_samp += start
+        start = 0
+    stop = min(start + n_samp, nsamples)
+
+    if freq_id_high is None:
+        freq_id_high = nchans
+    freqs = get_frequencies(header)[freq_id_low:freq_id_high]
+
+    # (time, channel) -> (channel, time), in ascending frequency order
+    if header['foff'] < 0:
+        window = data[start:stop, 0, nchans - freq_id_high:nchans - freq_id_low].T[::-1, :]
+    else:
+        window = data[start:stop, 0, freq_id_low:freq_id_high].T
+
+    return Spectra(freqs, dt, window, starttime=start * dt, copy=copy)
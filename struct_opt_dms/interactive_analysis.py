@@ -1,8 +1,7 @@
 from .extern.time_domain_astronomy_sandbox.backend import Backend
-from .extern.time_domain_astronomy_sandbox.observation import Observation
 from .extern.time_domain_astronomy_sandbox.rfim import RFIm
 
-from .plotting import plot_coherent_power, plot_waterfall
+from .plotting import plot_coherent_power, plot_waterfall, FigureController
 from .processing import (
     get_dm_trials,
     read_filterbank,
@@ -12,14 +11,22 @@ from .processing import (
     subband,
 )
 from .dm_phase import get_coherent_power, dedisperse_waterfall
+from .coherent_power import get_power_vs_dm, get_d_power_vs_dm, CumulativeSpectrum
+from .smoothing_cache import smoothing_cache
+from .dm_search import adaptive_dm_search
 
 import numpy as np
-import scipy.ndimage.filters as filters
 
 import builtins
 
 import copy
 
+# RFI mitigation applied by `prep_data` (keyword arguments of each RFIm method)
+RFI_SETTINGS = {
+    'dm0clean': {'threshold': 3.25},
+    'tdsc_amber': {'threshold': 3.25, 'n_iter': 1, 'symetric': False},
+}
+
 """
  Note:
     Backend() currently is only used with default inputs,
@@ -87,6 +94,11 @@ def set_layout(fig, gs):
 
     return ax_t_snr, ax_waterfall, ax_power_prof, ax_power#, ax_power_res
 
+def get_figure_controller(fig, gs):
+    """Figure controller updating the figure of `select_frequency_range` in
+    place (see plotting.FigureController), to pass as its `controller`."""
+    return FigureController(fig, set_layout(fig, gs))
+
 def select_frequency_range(spectra,
                            dm_trials,
                            fig,
@@ -104,8 +116,20 @@ def select_frequency_range(spectra,
                            ds_freq = 1,
                            ds_time = 1,
                            delta_dm = 0,
-                           smooth = 0):
-    """Select a frequency range from the waterfall 2D array."""
+                           smooth = 0,
+                           cumulative_spectrum = None,
+                           controller = None):
+    """Select a frequency range from the waterfall 2D array.
+
+    If `cumulative_spectrum` (see `prep_cumulative_spectrum`) is given,
+    `power_vs_dm` and `d_power_vs_dm` are recomputed for the selected
+    frequency range from it instead of using the arrays passed in. These
+    use unrounded dispersion delays, so they are close to, but not the same
+    as, `prep_power` on that range (see coherent_power.CumulativeSpectrum).
+
+    If `controller` (see `get_figure_controller`) is given, the figure is
+    updated in place instead of being cleared and plotted again.
+    """
 
     builtins.fluct_id_low = fluct_id_low
     builtins.fluct_id_high = fluct_id_high
@@ -119,7 +143,8 @@ def select_frequency_range(spectra,
     builtins.smooth = smooth
 
     # Prep figure layout
-    ax_t_snr, ax_waterfall, ax_power_prof, ax_power = set_layout(fig, gs)
+    if controller is None:
+        ax_t_snr, ax_waterfall, ax_power_prof, ax_power = set_layout(fig, gs)
 
     # Initialize observation data
     waterfall, f_channels, freq_id_high, t1 = initialize_observation(spectra,
@@ -128,29 +153,54 @@ def select_frequency_range(spectra,
                                                                      t0=t0,
                                                                      t1=t1)
 
-    dm, dm_std, snr = plot_coherent_power(filters.gaussian_filter(power_vs_dm, smooth),
-                                          filters.gaussian_filter(d_power_vs_dm, smooth),
-                                          dm_trials,
-                                          f_channels,
-                                          waterfall.shape[0],
-                                          spectra.dm,
-                                          spectra.dt,
-                                          delta_dm,
-                                          t0,
-                                          t1,
-                                          fluct_id_low,
-                                          fluct_id_high,
-                                          ax_power,
-                                          ax_power_prof,
-                                          # ax_power_res,
-                                          descriptor=descriptor,
-                                          fitting_method = fitting_method)
-
-    ax_power.vlines(dm + delta_dm + spectra.dm,
-                    ax_power.get_ylim()[0],
-                    ax_power.get_ylim()[1],
-                    alpha=0.7,
-                    color='red')
+    if cumulative_spectrum is not None:
+        power_vs_dm, d_power_vs_dm = cumulative_spectrum.power_vs_dm(freq_id_low, freq_id_high)
+
+    # smoothed maps are cached: only changing `smooth` (or the power maps)
+    # filters them again
+    smoothed_power_vs_dm = smoothing_cache.smoothed(power_vs_dm, smooth)
+    smoothed_d_power_vs_dm = smoothing_cache.smoothed(d_power_vs_dm, smooth)
+    dm_curve = smoothing_cache.band_sum(d_power_vs_dm, smooth, fluct_id_low, fluct_id_high)
+
+    if controller is None:
+        dm, dm_std, snr = plot_coherent_power(smoothed_power_vs_dm,
+                                              smoothed_d_power_vs_dm,
+                                              dm_trials,
+                                              f_channels,
+                                              waterfall.shape[0],
+                                              spectra.dm,
+                                              spectra.dt,
+                                              delta_dm,
+                                              t0,
+                                              t1,
+                                              fluct_id_low,
+                                              fluct_id_high,
+                                              ax_power,
+                                              ax_power_prof,
+                                              # ax_power_res,
+                                              descriptor=descriptor,
+                                              fitting_method = fitting_method,
+                                              dm_curve=dm_curve)
+
+        ax_power.vlines(dm + delta_dm + spectra.dm,
+                        ax_power.get_ylim()[0],
+                        ax_power.get_ylim()[1],
+                        alpha=0.7,
+                        color='red')
+    else:
+        dm, dm_std, snr = controller.update_power(smoothed_power_vs_dm,
+                                                  smoothed_d_power_vs_dm,
+                                                  dm_trials,
+                                                  f_channels,
+                                                  waterfall.shape[0],
+                                                  spectra.dm,
+                                                  spectra.dt,
+                                                  delta_dm,
+                                                  fluct_id_low,
+                                                  fluct_id_high,
+                                                  descriptor=descriptor,
+                                                  fitting_method = fitting_method,
+                                                  dm_curve=dm_curve)
 
     builtins.struct_opt_dm = spectra.dm + delta_dm + dm
     builtins.struct_opt_dm_err = dm_std
@@ -170,23 +220,37 @@ def select_frequency_range(spectra,
         dim='time'
     )
 
-    plot_waterfall(builtins.sub_waterfall,
-                   f_channels,
-                   t0,
-                   t1,
-                   freq_id_low,
-                   freq_id_high,
-                   ax_waterfall,
-                   ax_t_snr,
-                   ax_power_prof,
-                   # ax_power_res,
-                   spectra.dm,
-                   spectra.dt,
-                   delta_dm + dm,
-                   dm_std)
-
-    fig.canvas.draw()
-    display(fig)
+    if controller is None:
+        plot_waterfall(builtins.sub_waterfall,
+                       f_channels,
+                       t0,
+                       t1,
+                       freq_id_low,
+                       freq_id_high,
+                       ax_waterfall,
+                       ax_t_snr,
+                       ax_power_prof,
+                       # ax_power_res,
+                       spectra.dm,
+                       spectra.dt,
+                       delta_dm + dm,
+                       dm_std)
+
+        fig.canvas.draw()
+        display(fig)
+    else:
+        controller.update_waterfall(builtins.sub_waterfall,
+                                    f_channels,
+                                    t0,
+                                    t1,
+                                    freq_id_low,
+                                    freq_id_high,
+                                    spectra.dm,
+                                    spectra.dt,
+                                    delta_dm + dm,
+                                    dm_std)
+        if not controller.draw():
+            display(fig)
 
 def prep_power(spectra,
                dm_trials,
@@ -194,7 +258,61 @@ def prep_power(spectra,
                freq_id_high = None,
                t0 = 0,
                t1 = None,
+               engine = 'fourier',
+               executor = None,
+               n_workers = None,
+               pool = 'thread',
+               workers = None,
+               dtype = np.complex128,
+               weights = None,
+               cache = None,
                verbose=False):
+    """Compute the coherent power (and its derivative weighting) vs DM.
+
+    `engine` selects how DM trials are evaluated:
+        'fourier': FFT the waterfall once and apply per-channel phase ramps
+                   for each DM trial (see coherent_power.py).
+        'time': dedisperse the waterfall and FFT it for each DM trial.
+
+    With the 'fourier' engine, DM trials can be evaluated in parallel by
+    passing a concurrent.futures `executor`, or `n_workers` to create a
+    `pool` ('thread' or 'process'). The output does not depend on it. The
+    'time' engine evaluates DM trials serially, and raises a ValueError if
+    any of them is given.
+
+    `workers` sets the number of FFT workers, and `dtype=np.complex64`
+    runs the 'fourier' engine in single precision.
+
+    `weights` gives a weight to each channel of `spectra` (e.g. from
+    `coherent_power.get_channel_weights` on an RFI mask); channels of zero
+    weight are left out of the coherent spectrum.
+
+    If a `cache` (power_cache.PowerCache) is given, the power maps are
+    looked up (and stored) under a key made of the input file (or data),
+    the processing recorded by `prep_data` and the arguments above.
+    """
+    if engine == 'time' and (executor is not None or n_workers is not None or pool != 'thread'):
+        raise ValueError("`executor`, `n_workers` and `pool` only apply to the 'fourier' engine")
+
+    if cache is not None:
+        key = cache.key(filename=getattr(spectra, 'filename', None),
+                        data=None if hasattr(spectra, 'filename') else spectra.data,
+                        processing=getattr(spectra, 'processing', None),
+                        dm_trials=dm_trials,
+                        freq_id_low=freq_id_low,
+                        freq_id_high=freq_id_high,
+                        t0=t0,
+                        t1=t1,
+                        engine=engine,
+                        dtype=np.dtype(dtype).str,
+                        weights=weights)
+        cached = cache.load(key)
+        if cached is not None:
+            if verbose:
+                print ('Loaded coherent power vs DM from cache.')
+                print ()
+            return cached
+
     if verbose:
         print ('Computing coherent power vs DM...')
         print ()
@@ -204,25 +322,143 @@ def prep_power(spectra,
                                                                      t0=t0,
                                                                      t1=t1)
 
+    if weights is not None:
+        weights = np.asarray(weights)[freq_id_low:freq_id_high]
+
     # Compute coherent power vs DM
     nbin = int(np.round(waterfall.shape[1] / 2))
     # global power_vs_dm
-    power_vs_dm = np.zeros([nbin, dm_trials.size])
-    for i, dm in enumerate(dm_trials):
-        power_vs_dm[:, i] = get_coherent_power(
-            dedisperse_waterfall(waterfall,
-                                 dm,
-                                 f_channels,
-                                 spectra.dt)
-        )[:nbin]
-
-    omega = np.arange(0, nbin)
-    d_power_vs_dm = omega[:, np.newaxis]**2 * power_vs_dm
+    if engine == 'fourier':
+        power_vs_dm = get_power_vs_dm(waterfall,
+                                      dm_trials,
+                                      f_channels,
+                                      spectra.dt,
+                                      nbin=nbin,
+                                      executor=executor,
+                                      n_workers=n_workers,
+                                      pool=pool,
+                                      workers=workers,
+                                      dtype=dtype,
+                                      weights=weights)
+    elif engine == 'time':
+        power_vs_dm = np.zeros([nbin, dm_trials.size])
+        dedispersed = np.empty_like(waterfall)
+        index = np.empty(waterfall.shape, dtype=np.intp)
+        for i, dm in enumerate(dm_trials):
+            power_vs_dm[:, i] = get_coherent_power(
+                dedisperse_waterfall(waterfall,
+                                     dm,
+                                     f_channels,
+                                     spectra.dt,
+                                     out=dedispersed,
+                                     index=index),
+                workers=workers,
+                weights=weights
+            )[:nbin]
+    else:
+        raise ValueError("`engine` must be 'fourier' or 'time', got %s" % engine)
+
+    d_power_vs_dm = get_d_power_vs_dm(power_vs_dm)
+
+    if cache is not None:
+        cache.save(key, power_vs_dm, d_power_vs_dm)
 
     return power_vs_dm, d_power_vs_dm
 
-def prep_data(file, estimated_dm, downsampling, around_peak=True, verbose=False):
+def prep_adaptive_power(spectra,
+                        dm_range = 10,
+                        dm_step = None,
+                        freq_id_low = 0,
+                        freq_id_high = None,
+                        t0 = 0,
+                        t1 = None,
+                        fluct_id_low = 0,
+                        fluct_id_high = None,
+                        weights = None,
+                        verbose=False,
+                        **power_kwargs):
+    """Compute the coherent power vs DM on coarse-to-fine DM trials.
+
+    Alternative to `prep_power` on a uniform grid: DM trials are chosen by
+    dm_search.adaptive_dm_search, with a coarse grid of half-width
+    `dm_range` (and step `dm_step`, sized from the smearing if None)
+    refined around the peak of the DM curve of fluctuation frequencies
+    [fluct_id_low, fluct_id_high). `power_kwargs` (e.g. `n_workers`) are
+    passed to coherent_power.get_power_vs_dm.
+
+    Returns
+    -------
+    dm_trials, power_vs_dm, d_power_vs_dm :
+        Sorted (non-uniform) DM trials relative to `spectra.dm`, and the
+        power maps for those trials
+    """
+    if verbose:
+        print ('Computing coherent power vs DM on adaptive DM trials...')
+        print ()
+    waterfall, f_channels, freq_id_high, t1 = initialize_observation(spectra,
+                                                                     freq_id_low=freq_id_low,
+                                                                     freq_id_high=freq_id_high,
+                                                                     t0=t0,
+                                                                     t1=t1)
+
+    if weights is not None:
+        weights = np.asarray(weights)[freq_id_low:freq_id_high]
+
+    # same fluctuation frequency bins as `prep_power`
+    power_kwargs.setdefault('nbin', int(np.round(waterfall.shape[1] / 2)))
+    dm_trials, power_vs_dm, d_power_vs_dm, _, _ = adaptive_dm_search(waterfall,
+                                                                     f_channels,
+                                                                     spectra.dt,
+                                                                     dm=spectra.dm,
+                                                                     dm_range=dm_range,
+                                                                     dm_step=dm_step,
+                                                                     fluct_id_low=fluct_id_low,
+                                                                     fluct_id_high=fluct_id_high,
+                                                                     weights=weights,
+                                                                     **power_kwargs)
+    return dm_trials, power_vs_dm, d_power_vs_dm
+
+def prep_cumulative_spectrum(spectra,
+                             dm_trials,
+                             t0 = 0,
+                             t1 = None,
+                             chan_step = 1,
+                             verbose=False):
+    """Compute the coherent spectrum vs DM accumulated over channels.
+
+    The returned CumulativeSpectrum gives `power_vs_dm`/`d_power_vs_dm`
+    for any frequency range without recomputing FFTs, e.g. when passed
+    to `select_frequency_range` as `cumulative_spectrum`. Delays are not
+    rounded to whole samples, so the maps differ from `prep_power` on the
+    same range, mostly at high fluctuation frequencies (see
+    coherent_power.CumulativeSpectrum).
+    """
+    if verbose:
+        print ('Computing cumulative coherent spectrum vs DM...')
+        print ()
+    waterfall, f_channels, _, t1 = initialize_observation(spectra,
+                                                          t0=t0,
+                                                          t1=t1)
+
+    return CumulativeSpectrum(waterfall,
+                              dm_trials,
+                              f_channels,
+                              spectra.dt,
+                              chan_step=chan_step)
+
+def prep_data(file, estimated_dm, downsampling, around_peak=True, dm_step=0.1, dm_range=10,
+              rfi_settings=None, t_zoom=0.1, verbose=False):
     """Prepare waterfall data for analysis and plotting
+
+    `dm_step` and `dm_range` set the uniform grid of DM trials around the
+    estimated DM. See `prep_adaptive_power` for a coarse-to-fine
+    alternative to a dense grid.
+
+    `rfi_settings` (default: RFI_SETTINGS) holds the keyword arguments
+    of the RFIm cleaning steps, and `t_zoom` the length (in seconds) of the
+    cropped waterfall. The file name and processing parameters are recorded
+    in `spectra.filename` and `spectra.processing` (used by `prep_power`'s
+    cache).
     """
     if verbose:
         print ('Preprocessing data...')
@@ -231,16 +467,19 @@ def prep_data(file, estimated_dm, downsampling, around_peak=True, verbose=False)
     t_res = Backend().sampling_time
     f_channels = Backend().frequencies
     dm_trials = get_dm_trials(estimated_dm = 0,
-                          dm_step = 0.1,
-                          dm_range = 10)
+                          dm_step = dm_step,
+                          dm_range = dm_range)
 
     spectra = read_filterbank(file,
                               t_res = t_res,
                               f_channels = f_channels)
 
-    spectra.data = RFIm().dm0clean(spectra.data)
+    if rfi_settings is None:
+        rfi_settings = RFI_SETTINGS
+
+    spectra.data = RFIm().dm0clean(spectra.data, **rfi_settings['dm0clean'])
     spectra.data = correct_bandpass(spectra.data)
-    spectra.data = RFIm().tdsc_amber(spectra.data)
+    spectra.data = RFIm().tdsc_amber(spectra.data, **rfi_settings['tdsc_amber'])
     # spectra.data = RFIm().fdsc_amber(spectra.data)
 
     spectra.dedisperse(dm=estimated_dm)
@@ -249,15 +488,24 @@ def prep_data(file, estimated_dm, downsampling, around_peak=True, verbose=False)
 
     spectra.data = crop(spectra,
                         # t_zoom=0.05 if downsampling < 25 else 0.1 if downsampling > 1 else 0.015,
-                        0.1,
+                        t_zoom,
                         # 0.5,
                         around_peak = around_peak)
 
     spectra.data = to_snr(spectra.data)
 
+    spectra.filename = file
+    spectra.processing = {'estimated_dm': estimated_dm,
+                          'around_peak': around_peak,
+                          'rfi_settings': rfi_settings,
+                          't_zoom': t_zoom,
+                          't_res': t_res,
+                          'f_channels': f_channels}
+
     return spectra, dm_trials
 
-def initialize(input_filename, estimated_dm, downsampling, around_peak=None, verbose=False):
+def initialize(input_filename, estimated_dm, downsampling, around_peak=None, dm_step=0.1, dm_range=10,
+               rfi_settings=None, t_zoom=0.1, verbose=False):
     if verbose:
         print ('Loading data... %s' % (input_filename))
         print ()
@@ -273,20 +521,32 @@ def initialize(input_filename, estimated_dm, downsampling, around_peak=None, ver
                                            estimated_dm,
                                            downsampling,
                                            around_peak=True,
+                                           dm_step=dm_step,
+                                           dm_range=dm_range,
+                                           rfi_settings=rfi_settings,
+                                           t_zoom=t_zoom,
                                            verbose=verbose)
         except IndexError:
-            print ('Errror with %s' % file)
+            print ('Errror with %s' % input_filename)
             print ()
             spectra, dm_trials = prep_data(input_filename,
                                            estimated_dm,
                                            downsampling,
                                            around_peak=False,
+                                           dm_step=dm_step,
+                                           dm_range=dm_range,
+                                           rfi_settings=rfi_settings,
+                                           t_zoom=t_zoom,
                                            verbose=verbose)
     else:
         spectra, dm_trials = prep_data(input_filename,
                                        estimated_dm,
                                        downsampling,
                                        around_peak=around_peak,
+                                       dm_step=dm_step,
+                                       dm_range=dm_range,
+                                       rfi_settings=rfi_settings,
+                                       t_zoom=t_zoom,
                                        verbose=verbose)
 
     return spectra, dm_trials, input_filename
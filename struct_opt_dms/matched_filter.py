@@ -0,0 +1,139 @@
+'''
+Boxcar matched-filter S/N search of dedispersed profiles.
+
+Profiles are smoothed by a bank of top hats of increasing width (see
+`boxcar_smooth`), and each smoothed series is normalised by a robust
+estimate of its noise (median and MAD), so that the S/N is not biased by
+the burst itself or by residual RFI. The best width, S/N and arrival
+sample are returned for each profile, e.g. for each DM trial, giving an
+S/N vs DM curve to compare with the structure-optimised `dm_curve`.
+'''
+import numpy as np
+
+from .dm_phase import dedisperse_waterfall
+from .extern.psrpy.spectra import boxcar_smooth
+from .statistics import median_mad
+
+def get_widths(max_width=128):
+    """Boxcar widths (in samples): powers of two up to `max_width`."""
+    return 2 ** np.arange(int(np.log2(max_width)) + 1)
+
+def boxcar_snr(profiles, widths=None, n_workers=None):
+    """S/N of every sample of the profiles smoothed by each boxcar width.
+
+    Parameters
+    ----------
+    profiles : Numpy.Array
+        1D profile, or 2D Array of profiles (e.g. DM trial, time)
+    widths : list
+        Boxcar widths in samples (default: `get_widths()`)
+    n_workers : int
+        Number of threads computing the noise statistics, see statistics.py
+
+    Returns
+    -------
+    snr : Numpy.Array
+        Array of shape (len(widths),) + profiles.shape
+
+    """
+    if widths is None:
+        widths = get_widths()
+    smoothed = boxcar_smooth(profiles, widths, padval='median')
+    central, sigma = median_mad(smoothed, axis=-1, keepdims=True, normal=True, n_workers=n_workers)
+    sigma[sigma == 0] = np.inf
+    smoothed -= central
+    smoothed /= sigma
+    return smoothed
+
+def matched_filter(profiles, widths=None, block_size=64, n_workers=None):
+    """Best boxcar width, S/N and arrival sample of each profile.
+
+    Parameters
+    ----------
+    profiles : Numpy.Array
+        1D profile, or 2D Array of profiles (e.g. DM trial, time)
+    widths : list
+        Boxcar widths in samples (default: `get_widths()`)
+    block_size : int
+        Number of profiles searched at once, bounding the memory to
+        len(widths) x block_size x nsamp values
+    n_workers : int
+        Number of threads computing the noise statistics
+
+    Returns
+    -------
+    width, snr, sample : Numpy.Array, Numpy.Array, Numpy.Array
+        Best width, its S/N and the sample the best boxcar is centred on,
+        per profile (scalars for a 1D profile)
+
+    """
+    if widths is None:
+        widths = get_widths()
+    widths = np.asarray(widths)
+    profiles = np.asarray(profiles)
+    rows = profiles.reshape(-1, profiles.shape[-1])
+
+    best_width = np.empty(rows.shape[0], dtype=widths.dtype)
+    best_snr = np.empty(rows.shape[0])
+    best_sample = np.empty(rows.shape[0], dtype=int)
+    for start in range(0, rows.shape[0], block_size):
+        block = slice(start, start + block_size)
+        snr = boxcar_snr(rows[block], widths, n_workers=n_workers)
+        # best sample per width, then best width
+        samples = snr.argmax(axis=-1)
+        peaks = np.take_along_axis(snr, samples[..., np.newaxis], axis=-1)[..., 0]
+        width_id = peaks.argmax(axis=0)
+        profile_id = np.arange(width_id.size)
+        best_width[block] = widths[width_id]
+        best_snr[block] = peaks[width_id, profile_id]
+        best_sample[block] = samples[width_id, profile_id]
+
+    shape = profiles.shape[:-1]
+    if not shape:
+        return best_width[0], best_snr[0], best_sample[0]
+    return best_width.reshape(shape), best_snr.reshape(shape), best_sample.reshape(shape)
+
+def get_profiles(waterfall, dm_trials, freq, dt, ref_freq="top"):
+    """Dedispersed profile (mean over channels) for every DM trial.
+
+    Returns
+    -------
+    profiles : Numpy.Array
+        2D Array (DM trial, time)
+
+    """
+    profiles = np.empty([len(dm_trials), waterfall.shape[1]])
+    dedispersed = np.empty_like(waterfall)
+    index = np.empty(waterfall.shape, dtype=np.intp)
+    for i, dm in enumerate(dm_trials):
+        dedisperse_waterfall(waterfall, dm, freq, dt, ref_freq=ref_freq, out=dedispersed, index=index)
+        np.mean(dedispersed, axis=0, out=profiles[i])
+    return profiles
+
+def snr_vs_dm(waterfall, dm_trials, freq, dt, ref_freq="top", widths=None,
+              block_size=64, n_workers=None):
+    """Matched-filter S/N vs DM of a waterfall.
+
+    Parameters
+    ----------
+    waterfall : Numpy.Array
+        2D Array (channel, time)
+    dm_trials : Numpy.Array
+        DM trials (relative to the DM the waterfall is dedispersed to)
+    freq : Numpy.Array
+        Frequency of each channel (MHz)
+    dt : float
+        Sampling time (second)
+    ref_freq : str
+        Reference frequency for dedispersion ('top', 'center' or 'bottom')
+    widths, block_size, n_workers :
+        See `matched_filter`
+
+    Returns
+    -------
+    width, snr, sample : Numpy.Array, Numpy.Array, Numpy.Array
+        Best width, S/N and arrival sample for each DM trial
+
+    """
+    profiles = get_profiles(waterfall, dm_trials, freq, dt, ref_freq=ref_freq)
+    return matched_filter(profiles, widths=widths, block_size=block_size, n_workers=n_workers)
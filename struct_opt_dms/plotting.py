@@ -8,6 +8,7 @@ and provide interaction in a jupyter notebook.
 - D. Vohl, August 2020.
 '''
 
+import matplotlib
 import numpy as np
 from .dm_phase import fit_power
 from .processing import fit_coherent_power, compute_statistics, psnr
@@ -42,30 +43,26 @@ def get_xticklabels(t0, t1, dt):
             5
         )]
 
-def plot_coherent_power(power_vs_dm,
-                        d_power_vs_dm,
-                        dm_trials,
-                        f_channels,
-                        nchan,
-                        estimated_dm,
-                        dt,
-                        delta_dm,
-                        t0,
-                        t1,
-                        fluct_id_low,
-                        fluct_id_high,
-                        ax_power,
-                        ax_power_prof,
-                        # ax_power_res,
-                        fitting_method='dm_phase',
-                        descriptor='',
-                        cmap='viridis'):
-    """Plot coherent power: fluctuation freq. vs DM"""
+def fit_dm_curve_profile(dm_trials,
+                         dm_curve,
+                         f_channels,
+                         nchan,
+                         fluct_id_low,
+                         fluct_id_high,
+                         fitting_method='dm_phase',
+                         descriptor=''):
+    """Fit the DM curve (summed coherent power vs DM).
 
-    dm_curve = d_power_vs_dm[fluct_id_low : fluct_id_high].sum(axis=0)
-    # dm_curve = power_vs_dm[fluct_id_low : fluct_id_high].sum(axis=0)
-    X, Y = dm_trials, dm_curve
+    Returns
+    -------
+    dm, dm_std, snr : float
+        Fitted DM, its uncertainty and S/N
+    fit_x, fit_y : Numpy.Array
+        Fitted curve
+    label : str
+        Text shown over the DM curve
 
+    """
     if fitting_method == 'dm_phase':
         returns_poly, _range, snr, x, y = fit_power(dm_trials,
                                                     dm_curve,
@@ -74,24 +71,6 @@ def plot_coherent_power(power_vs_dm,
                                                     fluct_id_low,
                                                     fluct_id_high)
 
-        # Profile
-        ax_power_prof.plot(X, Y, linewidth=3, clip_on=False)
-        ax_power_prof.plot(X[_range],
-                           np.polyval(returns_poly[2], X[_range]),
-                           color='orange',
-                           linewidth=3,
-                           zorder=2,
-                           clip_on=False)
-        ax_power_prof.set_xlim([X.min(), X.max()])
-        ax_power_prof.set_ylim([Y.min(), Y.max()])
-        ax_power_prof.ticklabel_format(useOffset=False)
-
-        ax_power_prof.text(0.1, 0.8,
-                           'S/N=%.2f' % (snr),
-                           horizontalalignment='center',
-                           verticalalignment='center',
-                           transform=ax_power_prof.transAxes)
-
         # Residuals
         # res = y - np.polyval(returns_poly[2], x)
         # res -= res.min()
@@ -110,18 +89,70 @@ def plot_coherent_power(power_vs_dm,
         # ax_power_res.ticklabel_format(useOffset=False)
 
         dm, dm_std = returns_poly[0], returns_poly[1]
+        fit_x = dm_trials[_range]
+        fit_y = np.polyval(returns_poly[2], fit_x)
+        label = 'S/N=%.2f' % (snr)
     else:
-        dm, dm_std, snr, fit = fit_coherent_power(X, Y)
+        dm, dm_std, snr, fit = fit_coherent_power(dm_trials, dm_curve)
+        fit_x, fit_y = dm_trials, fit.best_fit
+        label = "%s   snr=%.2f" % (descriptor, psnr(dm_curve))
 
-        ax_power_prof.plot(X, Y, linewidth=3, clip_on=False)
-        ax_power_prof.plot(X, fit.best_fit, color='orange', zorder=2, clip_on=False)
+    return dm, dm_std, snr, fit_x, fit_y, label
 
-        ax_power_prof.text(0.1, 0.8,
-                           "%s   snr=%.2f" % (descriptor, psnr(Y)),
-                           horizontalalignment='center',
-                           verticalalignment='center',
-                           transform=ax_power_prof.transAxes)
+def plot_coherent_power(power_vs_dm,
+                        d_power_vs_dm,
+                        dm_trials,
+                        f_channels,
+                        nchan,
+                        estimated_dm,
+                        dt,
+                        delta_dm,
+                        t0,
+                        t1,
+                        fluct_id_low,
+                        fluct_id_high,
+                        ax_power,
+                        ax_power_prof,
+                        # ax_power_res,
+                        fitting_method='dm_phase',
+                        descriptor='',
+                        cmap='viridis',
+                        dm_curve=None):
+    """Plot coherent power: fluctuation freq. vs DM
 
+    `dm_curve` is the sum of `d_power_vs_dm` over the fluctuation range,
+    computed if not given.
+    """
+
+    if dm_curve is None:
+        dm_curve = d_power_vs_dm[fluct_id_low : fluct_id_high].sum(axis=0)
+    # dm_curve = power_vs_dm[fluct_id_low : fluct_id_high].sum(axis=0)
+    X, Y = dm_trials, dm_curve
+
+    dm, dm_std, snr, fit_x, fit_y, label = fit_dm_curve_profile(dm_trials,
+                                                                dm_curve,
+                                                                f_channels,
+                                                                nchan,
+                                                                fluct_id_low,
+                                                                fluct_id_high,
+                                                                fitting_method=fitting_method,
+                                                                descriptor=descriptor)
+
+    # Profile
+    ax_power_prof.plot(X, Y, linewidth=3, clip_on=False)
+    if fitting_method == 'dm_phase':
+        ax_power_prof.plot(fit_x, fit_y, color='orange', linewidth=3, zorder=2, clip_on=False)
+        ax_power_prof.set_xlim([X.min(), X.max()])
+        ax_power_prof.set_ylim([Y.min(), Y.max()])
+        ax_power_prof.ticklabel_format(useOffset=False)
+    else:
+        ax_power_prof.plot(fit_x, fit_y, color='orange', zorder=2, clip_on=False)
+
+    ax_power_prof.text(0.1, 0.8,
+                       label,
+                       horizontalalignment='center',
+                       verticalalignment='center',
+                       transform=ax_power_prof.transAxes)
 
     # Power vs DM map
     FT_len = power_vs_dm.shape[0]
@@ -210,3 +241,239 @@ def plot_waterfall(waterfall,
     ax_power_prof.axis('off')
     # ax_power_res.axis('off')
     ax_t_snr.axis('off')
+
+class FigureController():
+    """Figure of `select_frequency_range` updated in place.
+
+    The axes, images, lines and texts are created on the first update. The
+    following updates only change their data (`set_data`, `set_extent`,
+    `set_ydata`, ...). On interactive backends supporting it, the static
+    parts of the figure (axes, ticks, labels) are cached and only the
+    changed artists are redrawn (blitting); the whole figure is only drawn
+    again when the ticks change (e.g. a new time or frequency range).
+    """
+
+    def __init__(self, fig, axes, cmap='viridis'):
+        """Initialise FigureController class.
+
+        Parameters
+        ----------
+        fig : matplotlib.figure.Figure
+            Figure
+        axes : tuple
+            ax_t_snr, ax_waterfall, ax_power_prof, ax_power (see
+            `interactive_analysis.set_layout`)
+        cmap : str
+            Colour map of the images
+
+        """
+        self.fig = fig
+        self.ax_t_snr, self.ax_waterfall, self.ax_power_prof, self.ax_power = axes
+        self.cmap = cmap
+        self.artists = {}
+        self.background = None
+        # what the static parts of the figure depend on
+        self.layout = None
+        self._power_extent = None
+        self._ticks = None
+
+        self.interactive = _is_interactive_backend()
+        self.blit = self.interactive and getattr(fig.canvas, 'supports_blit', False)
+        if self.blit:
+            fig.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _on_draw(self, event):
+        """Cache the static parts of the figure and draw the artists over them."""
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        for artist in self.artists.values():
+            self.fig.draw_artist(artist)
+        # the frequency labels of the waterfall overlap the power map: draw
+        # them over it again
+        self.fig.draw_artist(self.ax_waterfall.yaxis)
+
+    def _create(self):
+        """Create the artists (with empty data) of both panels."""
+        empty = np.zeros((1, 1))
+        self.artists['power'] = self.ax_power.imshow(empty,
+                                                     origin='lower',
+                                                     aspect='auto',
+                                                     cmap=self.cmap,
+                                                     interpolation='nearest')
+        self.artists['dm_line'] = self.ax_power.axvline(0, alpha=0.7, color='red')
+        self.artists['dm_curve'], = self.ax_power_prof.plot([], [], linewidth=3, clip_on=False)
+        self.artists['dm_fit'], = self.ax_power_prof.plot([], [], color='orange', zorder=2, clip_on=False)
+        self.artists['dm_label'] = self.ax_power_prof.text(0.1, 0.8, '',
+                                                           horizontalalignment='center',
+                                                           verticalalignment='center',
+                                                           transform=self.ax_power_prof.transAxes)
+        self.ax_power.tick_params(axis='both',
+                                  direction='in',
+                                  right='on',
+                                  top='on')
+
+        self.artists['waterfall'] = self.ax_waterfall.imshow(empty,
+                                                             origin='lower',
+                                                             aspect='auto',
+                                                             cmap=self.cmap,
+                                                             interpolation='nearest')
+        self.artists['profile'], = self.ax_t_snr.plot([], [], '-', linewidth=2)
+        self.artists['profile_label'] = self.ax_t_snr.text(0.1, 0.8, '',
+                                                           horizontalalignment='center',
+                                                           verticalalignment='center',
+                                                           transform=self.ax_t_snr.transAxes)
+        self.ax_power_prof.axis('off')
+        self.ax_t_snr.axis('off')
+
+        if self.blit:
+            for artist in self.artists.values():
+                artist.set_animated(True)
+
+    def update_power(self,
+                     power_vs_dm,
+                     d_power_vs_dm,
+                     dm_trials,
+                     f_channels,
+                     nchan,
+                     estimated_dm,
+                     dt,
+                     delta_dm,
+                     fluct_id_low,
+                     fluct_id_high,
+                     fitting_method='dm_phase',
+                     descriptor='',
+                     dm_curve=None):
+        """Update the coherent power panels, see `plot_coherent_power`.
+
+        Returns
+        -------
+        dm, dm_std, snr : float
+
+        """
+        if not self.artists:
+            self._create()
+
+        if dm_curve is None:
+            dm_curve = d_power_vs_dm[fluct_id_low : fluct_id_high].sum(axis=0)
+        X, Y = dm_trials, dm_curve
+        dm, dm_std, snr, fit_x, fit_y, label = fit_dm_curve_profile(dm_trials,
+                                                                    dm_curve,
+                                                                    f_channels,
+                                                                    nchan,
+                                                                    fluct_id_low,
+                                                                    fluct_id_high,
+                                                                    fitting_method=fitting_method,
+                                                                    descriptor=descriptor)
+
+        # Profile (no ticks: limits only change how the lines are drawn)
+        self.artists['dm_curve'].set_data(X, Y)
+        self.artists['dm_fit'].set_data(fit_x, fit_y)
+        if fitting_method == 'dm_phase':
+            self.artists['dm_fit'].set_linewidth(3)
+        else:
+            self.artists['dm_fit'].set_linewidth(matplotlib.rcParams['lines.linewidth'])
+        self.artists['dm_label'].set_text(label)
+        self.ax_power_prof.set_xlim([X.min(), X.max()])
+        self.ax_power_prof.set_ylim([Y.min(), Y.max()])
+
+        # Power vs DM map
+        FT_len = power_vs_dm.shape[0]
+        indx2Ang = 1. / (2 * FT_len * dt * 1000)
+        extent = [np.min(X)+estimated_dm,
+                  np.max(X)+estimated_dm,
+                  fluct_id_low * indx2Ang,
+                  fluct_id_high * indx2Ang]
+        image = self.artists['power']
+        image.set_data(power_vs_dm[fluct_id_low : fluct_id_high])
+        image.set_extent(extent)
+        image.autoscale()
+        self.ax_power.set_xlim(extent[:2])
+        self.ax_power.set_ylim(extent[2:])
+        self.artists['dm_line'].set_xdata([dm + delta_dm + estimated_dm] * 2)
+
+        builtins.power_vs_dm = power_vs_dm[fluct_id_low : fluct_id_high]
+
+        self._power_extent = tuple(float(e) for e in extent)
+        return dm, dm_std, snr
+
+    def update_waterfall(self,
+                         waterfall,
+                         f_channels,
+                         t0,
+                         t1,
+                         freq_id_low,
+                         freq_id_high,
+                         dm,
+                         dt,
+                         delta_dm,
+                         dm_std):
+        """Update the waterfall panels, see `plot_waterfall`."""
+        if not self.artists:
+            self._create()
+
+        extent = (t0 - 0.5,
+                  t1 + 0.5,
+                  freq_id_low  - 0.5,
+                  freq_id_high + 0.5)
+        image = self.artists['waterfall']
+        image.set_data(waterfall)
+        image.set_extent(extent)
+        image.autoscale()
+        self.ax_waterfall.set_xlim(extent[:2])
+        self.ax_waterfall.set_ylim(extent[2:])
+
+        # ticks are only set again when they change
+        ticks = (t0, t1, freq_id_low, freq_id_high, dt,
+                 float(f_channels[0]), float(f_channels[-1]))
+        if ticks != self._ticks:
+            self.ax_waterfall.set_xticks(get_xticks(t0, t1))
+            self.ax_waterfall.set_xticklabels(get_xticklabels(t0, t1, dt))
+            self.ax_waterfall.set_yticks(get_yticks(freq_id_low, freq_id_high))
+            self.ax_waterfall.set_yticklabels(get_yticklabels(f_channels, freq_id_low, freq_id_high))
+            self._ticks = ticks
+
+        # summed profile
+        wat_prof = np.nansum(waterfall, axis=0)
+        self.artists['profile'].set_data(np.arange(wat_prof.size), wat_prof)
+        self.ax_t_snr.set_ylim([wat_prof.min()-1, wat_prof.max()+1])
+        self.ax_t_snr.set_xlim([0, wat_prof.size])
+        self.artists['profile_label'].set_text(
+            r'DM=%.2f $\pm$ %.2f pc/cm$^3$' % (dm + delta_dm, dm_std))
+
+    def draw(self):
+        """Show the updated figure.
+
+        Blits the changed artists over the cached background when possible,
+        and draws the whole figure otherwise (first draw, new ticks,
+        non-blitting backends).
+
+        Returns
+        -------
+        drawn : bool
+            Whether the figure has been shown. With non-interactive backends
+            (e.g. the notebook inline backend), it still has to be displayed
+            (`display(fig)`).
+
+        """
+        if not self.interactive:
+            return False
+
+        canvas = self.fig.canvas
+        layout = (self._power_extent, self._ticks)
+        if not self.blit or self.background is None or layout != self.layout:
+            self.layout = layout
+            canvas.draw_idle()
+        else:
+            canvas.restore_region(self.background)
+            self._draw_artists()
+            canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+        return True
+
+def _is_interactive_backend():
+    """Whether the current matplotlib backend draws figures in a window or widget."""
+    backend = matplotlib.get_backend().lower()
+    return not ('inline' in backend or
+                backend in ('agg', 'cairo', 'pdf', 'pgf', 'ps', 'svg', 'template'))
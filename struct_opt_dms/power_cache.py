@@ -0,0 +1,166 @@
+'''
+Persistent on-disk cache of coherent power vs DM maps.
+
+Entries are content-addressed: the key is a hash of the input filterbank's
+content and of every parameter that changes the power maps (RFI settings,
+crop, DM trials, channel and time ranges, ...). Each entry is a folder with
+`power_vs_dm.npy` and `d_power_vs_dm.npy`, loaded as read-only memory maps.
+Least recently used entries are evicted when the cache exceeds `max_bytes`.
+'''
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+_file_digests = {}
+
+def file_digest(filename, chunk_size=2**20):
+    """Hash of a file's content.
+
+    Digests are memoised per (path, size, modification time), so a file is
+    only read once per session unless it changes.
+    """
+    stat = os.stat(filename)
+    memo_key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_digests:
+        digest = hashlib.blake2b(digest_size=20)
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        _file_digests[memo_key] = digest.hexdigest()
+    return _file_digests[memo_key]
+
+def array_digest(array):
+    """Hash of a Numpy array's shape, type and content."""
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(array.tobytes(), digest_size=20)
+    digest.update(repr((array.shape, array.dtype.str)).encode())
+    return digest.hexdigest()
+
+def _to_json(value):
+    """Make parameters JSON serialisable (arrays are replaced by their hash)."""
+    if isinstance(value, np.ndarray):
+        return {'array': array_digest(value)}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {str(k): _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, type):
+        return value.__name__
+    return value
+
+class PowerCache():
+    """On-disk cache of `power_vs_dm`/`d_power_vs_dm` pairs."""
+
+    def __init__(self, folder='cache/power_vs_dm/', max_bytes=2**32):
+        """Initialise PowerCache class.
+
+        Parameters
+        ----------
+        folder : str
+            Folder holding the cache entries (created if needed)
+        max_bytes : int
+            Total size of the entries above which the least recently used
+            ones are evicted (default: 4 GiB)
+
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(self.folder, exist_ok=True)
+
+    def key(self, filename=None, data=None, **params):
+        """Key of the power maps of a filterbank processed with `params`.
+
+        Parameters
+        ----------
+        filename : str
+            Input filterbank, identified by the hash of its content
+        data : Numpy.Array
+            Input data, identified by the hash of its content, when the
+            filterbank is unknown
+        params :
+            Every parameter affecting the power maps (arrays are hashed)
+
+        Returns
+        -------
+        key : str
+
+        """
+        if filename is not None:
+            source = {'file': file_digest(filename)}
+        elif data is not None:
+            source = {'data': array_digest(data)}
+        else:
+            raise ValueError('Either `filename` or `data` is needed to identify the input')
+
+        description = json.dumps({'source': source, 'params': _to_json(params)}, sort_keys=True)
+        return hashlib.blake2b(description.encode(), digest_size=20).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.path(key), 'd_power_vs_dm.npy'))
+
+    def load(self, key):
+        """Load the power maps stored under `key` as read-only memory maps.
+
+        Returns
+        -------
+        power_vs_dm, d_power_vs_dm : Numpy.memmap, Numpy.memmap
+            or None if the key is not in the cache
+
+        """
+        if key not in self:
+            return None
+        path = self.path(key)
+        # mark as recently used
+        os.utime(path)
+        return (np.load(os.path.join(path, 'power_vs_dm.npy'), mmap_mode='r'),
+                np.load(os.path.join(path, 'd_power_vs_dm.npy'), mmap_mode='r'))
+
+    def save(self, key, power_vs_dm, d_power_vs_dm):
+        """Store the power maps under `key` and evict old entries if needed."""
+        if key in self:
+            return
+        # write to a temporary folder and rename it, so readers never see partial entries
+        tmp = tempfile.mkdtemp(dir=self.folder, prefix='.tmp_')
+        try:
+            np.save(os.path.join(tmp, 'power_vs_dm.npy'), power_vs_dm)
+            np.save(os.path.join(tmp, 'd_power_vs_dm.npy'), d_power_vs_dm)
+            os.replace(tmp, self.path(key))
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if key not in self:
+                raise
+        self.evict()
+
+    def entries(self):
+        """List (last use time, size in bytes, key) of every entry, oldest first."""
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.name))
+        return sorted(entries)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in `max_bytes`."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Remove every entry."""
+        for _, _, key in self.entries():
+            shutil.rmtree(self.path(key), ignore_errors=True)
@@ -1,7 +1,9 @@
 import numpy as np
-from blimpy import Waterfall
+import scipy.fft
 from .extern.psrpy.spectra import Spectra
+from .filterbank import read_filterbank_window
 from .extern.time_domain_astronomy_sandbox.backend import Backend
+from .statistics import median
 import lmfit
 
 """
@@ -20,13 +22,19 @@ def read_filterbank(filename:str,
                     t_res:float = Backend().sampling_time,
                     f_channels:list = Backend().frequencies[::-1],
                     output_type:str='spectra'):
+    """Read a filterbank file (channels in ascending frequency order).
 
-    data = Waterfall(filename).data[:,0,:].T[::-1, :]
+    The file is read through its memory map (see
+    filterbank.read_filterbank_window) into a float array.
+    """
+
+    data = read_filterbank_window(filename, copy=True).data
 
     if output_type == 'spectra':
         return Spectra(f_channels,
                        t_res,
-                       data)
+                       data,
+                       copy=False)
     elif output_type  == 'observation':
         return Observation(backend=Backend(),
                            length=data.data.shape[1]*data.dt,
@@ -47,7 +55,7 @@ def get_dm_trials(estimated_dm:float = 349.2,
 
 def correct_bandpass(spectra:Spectra):
     """Liam Connor's correct_bandpass"""
-    return spectra.data - np.median(spectra.data, axis=1, keepdims=True)
+    return spectra.data - median(spectra.data, axis=1, keepdims=True)
 
 def crop(spectra:Spectra,
          t_zoom:float = 0.25,
@@ -55,7 +63,7 @@ def crop(spectra:Spectra,
 
     n_samp = int(np.round(t_zoom / spectra.dt))
     if around_peak:
-        peak_ind = np.argmax(np.median(spectra.data, axis=0))
+        peak_ind = np.argmax(median(spectra.data, axis=0))
         start = int(np.round(peak_ind - (0.5 * n_samp)))
     else:
         start = int(np.round(spectra.data.shape[1]//2 - (0.5 * n_samp)))
@@ -96,18 +104,20 @@ def compute_statistics(profile, stat='median'):
     start = a-width
     end = b+width
     noisy = np.append(profile[0:start], profile[end:], axis=0)
+    noisy = noisy[~np.isnan(noisy)]
 
-    central = np.nanmean(noisy) if stat == 'mean' else np.nanmedian(noisy)
-    stdev = np.nanstd(noisy)
+    central = np.mean(noisy) if stat == 'mean' else median(noisy)
+    stdev = np.std(noisy)
 
     snr = (np.nanmax(profile)-central)/stdev if stdev != 0 else -1
 
     return central, stdev, snr
 
-def acf(x):
+def acf(x, workers=None):
+    """Autocorrelation of each row of x (real input FFTs, `workers` FFT workers)."""
     l = 2 ** int(np.log2(x.shape[1] * 2 - 1))
-    fftx = np.fft.fft(x, n = l, axis = 1)
-    ret = np.fft.ifft(fftx * np.conjugate(fftx), axis = 1)
+    fftx = scipy.fft.rfft(x, n = l, axis = 1, workers = workers)
+    ret = scipy.fft.irfft(fftx * np.conjugate(fftx), n = l, axis = 1, workers = workers)
     ret = np.fft.fftshift(ret, axes=1)
     return ret
 
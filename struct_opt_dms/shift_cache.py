@@ -0,0 +1,125 @@
+'''
+Cache of per-channel dispersion delay and shift tables.
+
+Dedispersion routines recompute the same per-channel delays every time they
+are called at a given DM. Tables are cached here, keyed by the kind of table,
+a hash of the frequency array, the sampling time, the DM and the reference
+frequency mode, with least-recently-used eviction under a memory cap.
+
+Cached tables are returned read-only since they are shared between callers.
+The cache is thread-safe.
+'''
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+class ShiftCache():
+    """LRU cache of read-only Numpy arrays with a memory cap."""
+
+    def __init__(self, max_bytes=2**27):
+        """Initialise ShiftCache class.
+
+        Parameters
+        ----------
+        max_bytes : int
+            Total size of the cached tables above which the least recently
+            used ones are evicted (default: 128 MiB)
+
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tables = OrderedDict()
+        # tables are requested from the threads evaluating DM trials
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tables)
+
+    def __contains__(self, key):
+        return key in self._tables
+
+    def get(self, key, compute):
+        """Get the table stored under `key`, computing it with `compute()` if missing.
+
+        Parameters
+        ----------
+        key : tuple
+            Hashable key of the table
+        compute : callable
+            Function without arguments returning the table
+
+        Returns
+        -------
+        table : Numpy.Array
+            Read-only table
+
+        """
+        with self._lock:
+            if key in self._tables:
+                self._tables.move_to_end(key)
+                self.hits += 1
+                return self._tables[key]
+            self.misses += 1
+
+        # computed without holding the lock, so other threads are not blocked
+        # (two threads missing the same key both compute it)
+        table = np.asarray(compute())
+        if not table.flags.owndata:
+            # do not make the caller's array (or a view of it) read-only
+            table = table.copy()
+        table.setflags(write=False)
+        with self._lock:
+            if key in self._tables:
+                return self._tables[key]
+            if table.nbytes <= self.max_bytes:
+                self._tables[key] = table
+                self.nbytes += table.nbytes
+                while self.nbytes > self.max_bytes:
+                    _, evicted = self._tables.popitem(last=False)
+                    self.nbytes -= evicted.nbytes
+        return table
+
+    def clear(self):
+        """Remove all tables from the cache."""
+        with self._lock:
+            self._tables.clear()
+            self.nbytes = 0
+
+def array_key(array):
+    """Hashable key of a Numpy array's shape, type and content."""
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(array.tobytes(), digest_size=16).hexdigest()
+    return array.shape, array.dtype.str, digest
+
+shift_cache = ShiftCache()
+
+def cached_table(kind, freqs, dt, dm, ref_freq, compute):
+    """Get a delay or shift table from the shared cache.
+
+    Parameters
+    ----------
+    kind : str
+        Name of the table (one per formula, e.g. 'dm_phase_shift')
+    freqs : Numpy.Array
+        Frequency of each channel (MHz)
+    dt : float
+        Sampling time (second)
+    dm : float
+        Dispersion measure (pc/cm^3)
+    ref_freq : hashable
+        Reference frequency (mode) the delays are relative to
+    compute : callable
+        Function without arguments computing the table on a cache miss
+
+    Returns
+    -------
+    table : Numpy.Array
+        Read-only table
+
+    """
+    key = (kind, array_key(freqs), float(dt), float(dm), ref_freq)
+    return shift_cache.get(key, compute)
@@ -0,0 +1,150 @@
+'''
+Cache of Gaussian-smoothed coherent power maps.
+
+The interactive figure smooths `power_vs_dm` and `d_power_vs_dm` with the
+`smooth` slider value at every widget change, although most sliders (time
+range, DM offset, fluctuation range, ...) do not change the smoothed maps.
+Smoothed maps are cached here, keyed by the identity of the power array and
+by `smooth`, with least-recently-used eviction under a memory cap.
+
+Each entry also keeps the cumulative sum of the smoothed map over the
+fluctuation frequency axis, so that the DM curve of any fluctuation range
+is the difference of two rows.
+
+Power arrays are identified by object, not by content: arrays must not be
+modified in place once smoothed (a new array is a new entry). Cached maps
+are returned read-only since they are shared between callers. Entries keep
+their power array alive (so that its id stays valid), so the memory of the
+power arrays counts towards the cap, once per underlying buffer.
+'''
+from collections import OrderedDict
+
+import numpy as np
+import scipy.ndimage.filters as filters
+
+class SmoothingCache():
+    """LRU cache of smoothed 2D maps and their cumulative sums with a memory cap."""
+
+    def __init__(self, max_bytes=2**28):
+        """Initialise SmoothingCache class.
+
+        Parameters
+        ----------
+        max_bytes : int
+            Total size of the cached maps and of the power arrays they
+            keep alive above which the least recently used maps are
+            evicted (default: 256 MiB)
+
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # id of the buffer of each source array -> [buffer, number of entries]
+        self._sources = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _entry(self, array, smooth):
+        """Cache entry of `array` smoothed with `smooth`, computing it if missing."""
+        key = (id(array), float(smooth))
+        entry = self._entries.get(key)
+        # the entry holds a reference to `array`, so its id cannot be reused
+        # by another array while cached; check it anyway
+        if entry is not None and entry['source'] is array:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        smoothed = filters.gaussian_filter(array, smooth)
+        smoothed.setflags(write=False)
+        entry = {'source': array, 'smoothed': smoothed, 'cumulative': None}
+        self._store(key, entry)
+        return entry
+
+    @staticmethod
+    def _buffer(array):
+        """Array owning the memory of `array` (`array` itself if not a view)."""
+        while isinstance(array.base, np.ndarray):
+            array = array.base
+        return array
+
+    def _store(self, key, entry):
+        if key in self._entries:
+            self._remove(key)
+        buffer = self._buffer(entry['source'])
+        nbytes = entry['smoothed'].nbytes
+        if id(buffer) not in self._sources:
+            nbytes += buffer.nbytes
+        if nbytes > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self.nbytes += entry['smoothed'].nbytes
+        self._sources.setdefault(id(buffer), [buffer, 0])[1] += 1
+        if self._sources[id(buffer)][1] == 1:
+            self.nbytes += buffer.nbytes
+        while self.nbytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.nbytes -= entry['smoothed'].nbytes
+        if entry['cumulative'] is not None:
+            self.nbytes -= entry['cumulative'].nbytes
+        buffer = self._buffer(entry['source'])
+        self._sources[id(buffer)][1] -= 1
+        if self._sources[id(buffer)][1] == 0:
+            del self._sources[id(buffer)]
+            self.nbytes -= buffer.nbytes
+
+    def smoothed(self, array, smooth):
+        """`array` smoothed by a Gaussian filter of standard deviation `smooth`.
+
+        Returns
+        -------
+        smoothed : Numpy.Array
+            Read-only smoothed map
+
+        """
+        return self._entry(array, smooth)['smoothed']
+
+    def band_sum(self, array, smooth, fluct_id_low, fluct_id_high):
+        """Sum of the rows [fluct_id_low, fluct_id_high) of the smoothed `array`.
+
+        Computed from the cumulative sum of the smoothed map over its first
+        axis, i.e. in O(n_dm) once the map is cached.
+
+        Returns
+        -------
+        band_sum : Numpy.Array
+            1D Array (DM trial)
+
+        """
+        entry = self._entry(array, smooth)
+        if entry['cumulative'] is None:
+            smoothed = entry['smoothed']
+            cumulative = np.zeros((smoothed.shape[0] + 1,) + smoothed.shape[1:],
+                                  dtype=np.result_type(smoothed.dtype, np.float64))
+            np.cumsum(smoothed, axis=0, out=cumulative[1:])
+            cumulative.setflags(write=False)
+            entry['cumulative'] = cumulative
+            if any(e is entry for e in self._entries.values()):
+                self.nbytes += cumulative.nbytes
+                # the entry is the most recently used: evict older ones
+                while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                    self._remove(next(iter(self._entries)))
+
+        # same bounds as array[fluct_id_low:fluct_id_high]
+        low, high, _ = slice(fluct_id_low, fluct_id_high).indices(entry['cumulative'].shape[0] - 1)
+        return entry['cumulative'][max(low, high)] - entry['cumulative'][low]
+
+    def clear(self):
+        """Remove all maps from the cache."""
+        self._entries.clear()
+        self._sources.clear()
+        self.nbytes = 0
+
+smoothing_cache = SmoothingCache()
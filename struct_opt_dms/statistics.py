@@ -0,0 +1,132 @@
+'''
+Robust statistics along an axis.
+
+Medians, median absolute deviations and trimmed means are computed with
+`np.partition` (linear-time selection) on a single copy of the data, keep
+the input's floating point type (no upcast of float32 data), and can be
+split over blocks of rows reduced in parallel by a thread pool (NumPy
+releases the GIL while partitioning).
+'''
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Scale of the MAD to the standard deviation of normally distributed data
+MAD_TO_STD = 1.482602218505602
+
+def _float_array(a):
+    a = np.asarray(a)
+    return a if np.issubdtype(a.dtype, np.floating) else a.astype(np.float64)
+
+def _reduce(func, a, axis, keepdims, n_workers):
+    """Apply `func` (reducing the last axis of a 2D array) along `axis` of `a`,
+    over blocks of rows in a thread pool of `n_workers` if given.
+
+    `func` returns one value, or a fixed number of values, per row.
+    """
+    a = _float_array(a)
+    if axis is None:
+        out_shape = ()
+        rows = a.reshape(1, -1)
+    else:
+        axis = axis % a.ndim
+        moved = np.moveaxis(a, axis, -1)
+        out_shape = moved.shape[:-1]
+        rows = moved.reshape(-1, moved.shape[-1])
+
+    if n_workers is None or n_workers < 2 or rows.shape[0] < 2:
+        out = func(rows)
+    else:
+        blocks = np.array_split(rows, min(n_workers, rows.shape[0]), axis=0)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            out = np.concatenate(list(executor.map(func, blocks)))
+
+    out = out.reshape(out_shape + out.shape[1:])
+    if keepdims:
+        out = np.expand_dims(out, tuple(range(a.ndim)) if axis is None else axis)
+    return out[()] if out.ndim == 0 else out
+
+def _median_rows(rows):
+    n = rows.shape[-1]
+    low, high = (n - 1) // 2, n // 2
+    # NaNs are sorted last: also selecting the last element tells which rows
+    # have one, whose median is NaN (as np.median)
+    part = np.partition(rows, [low, high, n - 1], axis=-1)
+    if low == high:
+        med = part[:, low]
+    else:
+        med = np.mean(part[:, low:high + 1], axis=-1)
+    return np.where(np.isnan(part[:, -1]), part[:, -1], med)
+
+def _mad_rows(rows):
+    deviation = rows - _median_rows(rows)[:, np.newaxis]
+    np.abs(deviation, out=deviation)
+    return _median_rows(deviation)
+
+def median(a, axis=None, keepdims=False, n_workers=None):
+    """Median along `axis` (same values as `np.median`, NaN if any data are).
+
+    Parameters
+    ----------
+    a : Numpy.Array
+        Input data
+    axis : int
+        Axis along which the median is computed (default: flattened array)
+    keepdims : bool
+        Keep the reduced axis with size one
+    n_workers : int
+        Number of threads reducing blocks of rows (default: None, serial)
+
+    Returns
+    -------
+    median : Numpy.Array or float
+        Of the floating point type of `a`
+
+    """
+    return _reduce(_median_rows, a, axis, keepdims, n_workers)
+
+def mad(a, axis=None, keepdims=False, normal=False, n_workers=None):
+    """Median absolute deviation from the median along `axis`.
+
+    If `normal`, the MAD is scaled to estimate the standard deviation of
+    normally distributed data. See `median` for the other parameters.
+    """
+    out = _reduce(_mad_rows, a, axis, keepdims, n_workers)
+    return out * out.dtype.type(MAD_TO_STD) if normal else out
+
+def median_mad(a, axis=None, keepdims=False, normal=False, n_workers=None):
+    """Median and MAD along `axis`, selecting the median only once.
+
+    See `mad` for the parameters.
+
+    Returns
+    -------
+    median, mad : Numpy.Array, Numpy.Array
+
+    """
+    def func(rows):
+        med = _median_rows(rows)
+        deviation = rows - med[:, np.newaxis]
+        np.abs(deviation, out=deviation)
+        return np.stack([med, _median_rows(deviation)], axis=-1)
+
+    out = _reduce(func, a, axis, keepdims, n_workers)
+    med, dev = out[..., 0], out[..., 1]
+    return med, dev * dev.dtype.type(MAD_TO_STD) if normal else dev
+
+def trimmed_mean(a, proportion=0.1, axis=None, keepdims=False, n_workers=None):
+    """Mean along `axis` after removing the `proportion` lowest and highest values.
+
+    See `median` for the other parameters.
+    """
+    def func(rows):
+        n = rows.shape[-1]
+        cut = int(proportion * n)
+        if cut == 0:
+            return np.mean(rows, axis=-1)
+        part = np.partition(rows, [cut, n - cut - 1], axis=-1)
+        return np.mean(part[:, cut:n - cut], axis=-1)
+
+    if not 0 <= proportion < 0.5:
+        raise ValueError('`proportion` must be in [0, 0.5), got %s' % proportion)
+    return _reduce(func, a, axis, keepdims, n_workers)
@@ -0,0 +1,182 @@
+'''
+Streaming RFI cleaning of arbitrarily long filterbank observations.
+
+The filterbank is read in fixed-size blocks of time samples through its
+memory map, and blocks are cleaned one after the other with constant memory.
+The time domain sigma cut uses per-channel statistics accumulated over all
+the blocks seen so far (Welford/Chan updates), instead of statistics of the
+whole 2D array as in RFIm.tdsc_amber. Cleaned blocks are yielded, or written
+to a new (32 bit) filterbank file.
+'''
+import numpy as np
+
+from .extern.time_domain_astronomy_sandbox.rfim import RFIm
+from .filterbank import open_filterbank, write_header
+
+class RunningStats():
+    """Per-channel running mean and variance over blocks of samples."""
+
+    def __init__(self, nchan):
+        """Initialise RunningStats class.
+
+        Parameters
+        ----------
+        nchan : int
+            Number of channels
+
+        """
+        self.count = 0
+        self.mean = np.zeros([nchan, 1])
+        self.m2 = np.zeros([nchan, 1])
+
+    def update(self, block):
+        """Add a (channel, time) block of samples to the statistics."""
+        n = block.shape[1]
+        if n == 0:
+            return
+        block_mean = np.mean(block, axis=1, keepdims=True, dtype=np.float64)
+        block_m2 = np.sum((block - block_mean)**2, axis=1, keepdims=True, dtype=np.float64)
+
+        # Chan et al. pairwise combination of (count, mean, M2)
+        total = self.count + n
+        delta = block_mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + block_m2 + delta**2 * self.count * n / total
+        self.count = total
+
+    @property
+    def var(self):
+        return self.m2 / self.count if self.count > 0 else np.zeros_like(self.m2)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+def iter_filterbank_blocks(filename, block_size=12500, dtype=np.float32):
+    """Iterate over blocks of time samples of a filterbank file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the filterbank file
+    block_size : int
+        Number of time samples per block (default: 12500, one second of ARTS data)
+    dtype : Numpy.dtype
+        Type of the yielded blocks (default: float32)
+
+    Yields
+    ------
+    start, block : int, Numpy.Array
+        First time sample of the block, and 2D Array (channel, time) with
+        channels in ascending frequency order
+
+    """
+    header, data, _ = open_filterbank(filename)
+    return _iter_blocks(header, data, block_size, dtype)
+
+def _iter_blocks(header, data, block_size, dtype):
+    """Blocks of `data` (memory map of an open filterbank file), see
+    `iter_filterbank_blocks`."""
+    for start in range(0, data.shape[0], block_size):
+        block = data[start:start + block_size, 0, :].T
+        if header['foff'] < 0:
+            block = block[::-1, :]
+        yield start, block.astype(dtype)
+
+def clean_blocks(blocks,
+                 nchan,
+                 threshold=3.25,
+                 symetric=False,
+                 dm0clean=True,
+                 dm0_threshold=3.25,
+                 fdsc=False,
+                 fdsc_bin_size=32,
+                 fdsc_threshold=2.75):
+    """Clean a stream of (channel, time) blocks with constant memory.
+
+    Each block is cleaned (in place) by, in order:
+        - RFIm.dm0clean on the block, if `dm0clean`;
+        - a time domain sigma cut per channel (as RFIm.tdsc_amber) against
+          the running mean and standard deviation of the channel over all
+          blocks so far, including this one;
+        - RFIm.fdsc_amber on the block, if `fdsc`.
+
+    Parameters
+    ----------
+    blocks : iterable
+        (start, block) pairs, e.g. from `iter_filterbank_blocks`
+    nchan : int
+        Number of channels
+    threshold : float
+        Threshold of the time domain sigma cut
+    symetric : bool
+        Also cut values below the mean in the time domain sigma cut
+    dm0clean, dm0_threshold :
+        Whether to run RFIm.dm0clean, and its threshold
+    fdsc, fdsc_bin_size, fdsc_threshold :
+        Whether to run RFIm.fdsc_amber, and its parameters
+
+    Yields
+    ------
+    start, block : int, Numpy.Array
+        Cleaned blocks
+
+    """
+    rfim = RFIm()
+    stats = RunningStats(nchan)
+    for start, block in blocks:
+        if dm0clean:
+            block = rfim.dm0clean(block, threshold=dm0_threshold)
+
+        stats.update(block)
+        mean = stats.mean.astype(block.dtype)
+        cut = (threshold * stats.std).astype(block.dtype)
+        if symetric:
+            mask = np.abs(block - mean) > cut
+        else:
+            mask = block > mean + cut
+        np.copyto(block, mean, where=mask)
+
+        if fdsc:
+            block = rfim.fdsc_amber(block, bin_size=fdsc_bin_size, threshold=fdsc_threshold)
+
+        yield start, block
+
+def clean_filterbank(filename, output_filename=None, block_size=12500, **clean_kwargs):
+    """Clean a filterbank file block by block.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the input filterbank file
+    output_filename : str
+        Path to the cleaned (32 bit float) filterbank file. If None, the
+        cleaned blocks are yielded instead.
+    block_size : int
+        Number of time samples per block
+    clean_kwargs :
+        Passed to `clean_blocks`
+
+    Returns
+    -------
+    blocks : generator
+        (start, block) pairs if `output_filename` is None, else None
+
+    """
+    header, data, _ = open_filterbank(filename)
+    nchan = data.shape[2]
+    blocks = clean_blocks(_iter_blocks(header, data, block_size, np.float32),
+                          nchan,
+                          **clean_kwargs)
+    if output_filename is None:
+        return blocks
+
+    header = dict(header, nbits=32, nifs=1)
+    header.pop('nsamples', None)
+    header.pop('signed', None)
+    with open(output_filename, 'wb') as f:
+        write_header(f, header)
+        for start, block in blocks:
+            if header['foff'] < 0:
+                block = block[::-1, :]
+            f.write(np.ascontiguousarray(block.T, dtype=np.float32).tobytes())
@@ -1,29 +1,25 @@
 import os
 import pickle
+import shutil
 
-def run_fast_scandir(folder, ext, substrings=[]):
-    subfolders, files = [], []
-
-    for f in os.scandir(folder):
-        if f.is_dir():
-            subfolders.appaend(f.path)
-        if f.is_file():
-            if os.path.splitext(f.name)[1].lower() in ext:
-                if len(substrings) == 0:
-                    files.append(f.path)
-                else:
-                    found = True
-                    for s in substrings:
-                        if s not in os.path.splitext(f.name)[0]:
-                            found = False
-                    if found:
-                        files.append(f.path)
-
-    for folder in list(subfolders):
-        sf, f = run_fast_scandir(folder, ext, substrings)
-        subfolders.extend(sf)
-        files.extend(f)
-    return subfolders, files
+import numpy as np
+
+from .array_store import save_array, is_array, open_array, load_array
+from .discovery import find_files
+
+def run_fast_scandir(folder, ext, substrings=[], index=None, n_workers=16):
+    """Find files with an extension in `ext` (and every substring of
+    `substrings` in their name) under `folder`, recursively.
+
+    See discovery.find_files, which walks the tree in parallel and can
+    reuse a persistent `index` of unchanged directories.
+
+    Returns
+    -------
+    subfolders, files : list, list
+
+    """
+    return find_files(folder, ext, substrings, index=index, n_workers=n_workers)
 
 def check_underscore(string):
     if string != '':
@@ -37,27 +33,45 @@ def check_slash(string):
             string += '/'
     return string
 
-def save(variable, data, protocol=pickle.HIGHEST_PROTOCOL, state_prefix='', folder='states/'):
+def state_path(variable, state_prefix='', folder='states/'):
+    """Path of a state file, without extension."""
+    if state_prefix != '':
+        return check_slash(folder) + check_underscore(state_prefix) + variable
+    return check_slash(folder) + variable
+
+def save(variable, data, protocol=pickle.HIGHEST_PROTOCOL, state_prefix='', folder='states/',
+         compression='zlib'):
+    """Save a state variable.
+
+    Numpy arrays are stored as chunked, `compression`-compressed arrays
+    (see array_store.py) that can be read partially. Other data are pickled.
+    """
     if not os.path.exists(folder):
         os.makedirs(folder)
 
-    if state_prefix != '':
-        with open(check_slash(folder) + check_underscore(state_prefix) + variable + '.pickle', 'wb') as f:
-            pickle.dump(data, f, protocol)
+    path = state_path(variable, state_prefix, folder)
+    if type(data) in (np.ndarray, np.memmap) and not data.dtype.hasobject:
+        save_array(path + '.array', data, compression=compression)
+        # a state has a single format
+        if os.path.exists(path + '.pickle'):
+            os.remove(path + '.pickle')
     else:
-        with open(check_slash(folder) + variable + '.pickle', 'wb') as f:
+        with open(path + '.pickle', 'wb') as f:
             pickle.dump(data, f, protocol)
+        if os.path.isdir(path + '.array'):
+            shutil.rmtree(path + '.array')
 
-def load(variable, state_prefix='', folder='states/'):
-    if state_prefix != '':
-        if os.path.exists(folder + check_underscore(state_prefix) + variable + '.pickle'):
-            with open(folder + check_underscore(state_prefix) + variable + '.pickle', 'rb') as f:
-                return pickle.load(f)
-        else:
-            return None
-    else:
-        if os.path.exists(folder + variable + '.pickle'):
-            with open(folder + variable + '.pickle', 'rb') as f:
-                return pickle.load(f)
-        else:
-            return None
+def load(variable, state_prefix='', folder='states/', lazy=False):
+    """Load a state variable (None if it was not saved).
+
+    Arrays are read whole, or, if `lazy`, returned as an
+    array_store.StoredArray that reads only the slices asked for.
+    States saved as pickle files still load.
+    """
+    path = state_path(variable, state_prefix, folder)
+    if is_array(path + '.array'):
+        return open_array(path + '.array') if lazy else load_array(path + '.array')
+    if os.path.exists(path + '.pickle'):
+        with open(path + '.pickle', 'rb') as f:
+            return pickle.load(f)
+    return None